@@ -0,0 +1,57 @@
+'''
+Micro-benchmark comparing utils.parse_row with the compiled row converter
+and batch geometry encoding used by utils.insert_data. Run from the
+repository root:
+
+    PYTHONPATH=. python benchmarks/row_converter.py
+'''
+import timeit
+from sqlalchemy import Column
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.types import Boolean, DateTime, Integer, Numeric, Text
+from geoalchemy2.types import Geometry
+
+from sql4housing import utils
+
+ROWS = 20000
+COLUMNS = 20
+
+record_fields = {
+    '__tablename__': 'benchmark',
+    '_pk_': Column(Integer, primary_key=True),
+    'inspected_at': Column(DateTime),
+    'location': Column(Geometry(geometry_type='POINT', srid=4326)),
+    'passed': Column(Boolean),
+}
+for i in range(COLUMNS):
+    record_fields['text_%s' % i] = Column(Text)
+    record_fields['number_%s' % i] = Column(Numeric)
+Binding = type('DataRecord', (declarative_base(),), record_fields)
+
+row = {'inspected_at': '2019-05-01T12:30:00.000', 'passed': True,
+       'location': {'latitude': '41.88', 'longitude': '-87.63'},
+       ':id': 'row-abcd.efgh'}
+for i in range(COLUMNS):
+    row['text_%s' % i] = 'value %s' % i
+    row['number_%s' % i] = str(i)
+page = [dict(row) for _ in range(ROWS)]
+
+
+def run_parse_row():
+    for r in page:
+        utils.parse_row(r, Binding, 4326)
+
+
+def run_converter():
+    converter = utils.get_converter(Binding)
+    rows = [utils.convert_row(r, converter, 4326) for r in page]
+    # Geometries are encoded a batch at a time by the bulk writer
+    for name, parser in utils.get_batch_parsers(Binding, 4326).items():
+        parser([r[name] for r in rows])
+
+
+if __name__ == '__main__':
+    for name, func in [('parse_row', run_parse_row),
+                       ('convert_row', run_converter)]:
+        seconds = min(timeit.repeat(func, number=1, repeat=3))
+        print('%-12s %10.0f rows/s' % (name, ROWS / seconds))
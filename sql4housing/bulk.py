@@ -0,0 +1,183 @@
+'''
+Bulk writer used by every source to load parsed rows into the destination
+table.
+'''
+import io
+import json
+import math
+from datetime import date, datetime
+
+COPY_BATCH_SIZE = 5000
+COMMIT_ROWS = 100000
+COMMIT_MB = 100
+
+
+class CommitPolicy:
+    '''
+    Commits the session every commit_rows rows or commit_mb megabytes of
+    written data, whichever comes first, so that transactions stay bounded
+    and rows already committed survive a failure later in the load. Set on
+    a session as session.info['commit_policy'] to apply to every BulkWriter
+    using that session.
+
+    checkpoint, if set, is called with the session and the total number of
+    rows written just before each commit, so progress can be saved in the
+    same transaction as the rows.
+    '''
+    def __init__(self, commit_rows=COMMIT_ROWS, commit_mb=COMMIT_MB,
+                 checkpoint=None):
+        self.commit_rows = int(commit_rows) if commit_rows else None
+        self.commit_bytes = float(commit_mb) * 1024 ** 2 \
+            if commit_mb else None
+        self.checkpoint = checkpoint
+        self.rows = 0
+        self.bytes = 0
+        self.total = 0
+        self.commits = 0
+
+    def written(self, session, rows, size):
+        '''
+        Records a written batch and commits if a limit has been reached.
+        '''
+        self.rows += rows
+        self.bytes += size
+        self.total += rows
+        if (self.commit_rows and self.rows >= self.commit_rows) or \
+                (self.commit_bytes and self.bytes >= self.commit_bytes):
+            if self.checkpoint:
+                self.checkpoint(session, self.total)
+            session.commit()
+            self.commits += 1
+            self.rows = 0
+            self.bytes = 0
+
+
+class BulkWriter:
+    '''
+    Writes parsed rows into a table in batches. On PostgreSQL rows are
+    streamed through COPY ... FROM STDIN; every other dialect falls back to an
+    executemany Core insert. Rows are written on the session's connection so
+    they are committed along with the rest of the session.
+
+    batch_parsers maps column names to functions that convert a whole
+    batch of that column's values at once, e.g. geometries to EWKB.
+    '''
+    def __init__(self, session, table, circle_bar=None,
+                 batch_size=COPY_BATCH_SIZE, batch_parsers=None):
+        self.session = session
+        self.table = table
+        self.circle_bar = circle_bar
+        self.batch_size = batch_size
+        self.batch_parsers = batch_parsers or {}
+        # _pk_ is generated by the database
+        self.columns = [c for c in table.columns if not c.primary_key]
+        self.col_names = [c.name for c in self.columns]
+        self.use_copy = session.get_bind().dialect.name == 'postgresql'
+        self.rows_written = 0
+        self._batch = []
+
+    def write(self, row):
+        '''
+        Queues a parsed row, flushing once a full batch has been collected.
+        '''
+        self._batch.append(row)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def write_many(self, rows):
+        for row in rows:
+            self.write(row)
+
+    def flush(self):
+        '''
+        Writes any queued rows to the database.
+        '''
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+        for name, parser in self.batch_parsers.items():
+            values = parser([row.get(name) for row in batch])
+            for row, val in zip(batch, values):
+                row[name] = val
+        if self.use_copy:
+            size = self._copy(batch)
+        else:
+            size = self._executemany(batch)
+        self._written(len(batch), size)
+
+    def write_frame(self, df):
+        '''
+        Writes a DataFrame whose columns already hold the converted values
+        for the table (see utils.convert_frame). Each batch is serialized by
+        pandas in a single pass instead of row by row.
+        '''
+        self.flush()
+        for start in range(0, df.shape[0], self.batch_size):
+            batch = df.iloc[start:start + self.batch_size]
+            if self.use_copy:
+                buf = io.StringIO()
+                batch.to_csv(buf, header=False, index=False, na_rep='\\N')
+                size = buf.tell()
+                buf.seek(0)
+                self._copy_expert(buf, "WITH CSV NULL '\\N'")
+            else:
+                size = self._executemany(
+                    batch.astype(object).where(batch.notna(), None)
+                    .to_dict(orient='records'))
+            self._written(batch.shape[0], size)
+
+    def _written(self, rows, size):
+        self.rows_written += rows
+        if self.circle_bar:
+            self.circle_bar.next(n=rows)
+        policy = self.session.info.get('commit_policy')
+        if policy:
+            policy.written(self.session, rows, size)
+
+    def _copy(self, batch):
+        buf = io.StringIO()
+        for row in batch:
+            buf.write('\t'.join(
+                copy_value(row.get(name)) for name in self.col_names))
+            buf.write('\n')
+        size = buf.tell()
+        buf.seek(0)
+        self._copy_expert(buf)
+        return size
+
+    def _copy_expert(self, buf, options=''):
+        preparer = self.session.get_bind().dialect.identifier_preparer
+        sql = 'COPY %s (%s) FROM STDIN %s' % (
+            preparer.format_table(self.table),
+            ', '.join(preparer.quote(name) for name in self.col_names),
+            options)
+        cursor = self.session.connection().connection.cursor()
+        try:
+            cursor.copy_expert(sql, buf)
+        finally:
+            cursor.close()
+
+    def _executemany(self, batch):
+        params = [{name: row.get(name) for name in self.col_names}
+                  for row in batch]
+        self.session.execute(self.table.insert(), params)
+        # Rough size of the batch, for the commit policy
+        return sum(len(str(val)) for row in params for val in row.values())
+
+
+def copy_value(val):
+    '''
+    Encodes a parsed value for PostgreSQL's COPY text format.
+    '''
+    if val is None:
+        return '\\N'
+    if isinstance(val, float) and math.isnan(val):
+        return '\\N'
+    if isinstance(val, bool):
+        return 't' if val else 'f'
+    if isinstance(val, (datetime, date)):
+        return val.isoformat()
+    if isinstance(val, (dict, list)):
+        val = json.dumps(val)
+    return str(val).replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
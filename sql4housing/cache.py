@@ -0,0 +1,293 @@
+'''
+On-disk cache for downloaded source files and API responses.
+
+Cached copies are revalidated with conditional requests (ETag and
+Last-Modified), so a file is only downloaded again once it has changed. The
+cache is trimmed to a maximum size by evicting the least recently used
+entries.
+
+Dataset metadata (names, columns, counts) is small and changes rarely, so it
+is kept in memory for the life of the process and on disk for metadata_ttl
+seconds without being revalidated. DataFrames built from many requests,
+such as Census variables, are pickled whole.
+'''
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+import time
+import urllib.request
+
+import pandas as pd
+import requests
+
+from sql4housing import ui
+
+CHUNK_SIZE = 1 << 20
+
+settings = {
+    'enabled': True,
+    'directory': os.environ.get(
+        'SQL4HOUSING_CACHE_DIR',
+        os.path.join(os.path.expanduser('~'), '.cache', 'sql4housing')),
+    'max_bytes': int(os.environ.get('SQL4HOUSING_CACHE_MB', 5 * 1024)) \
+        * 1024 ** 2,
+    'metadata_ttl': int(os.environ.get(
+        'SQL4HOUSING_METADATA_TTL', 24 * 60 * 60)),
+}
+_lock = threading.Lock()
+_metadata = {}
+
+
+def configure(enabled=None, directory=None, max_bytes=None,
+              metadata_ttl=None):
+    '''
+    Changes the cache settings for the rest of the process. Arguments left
+    as None keep their current value.
+    '''
+    if enabled is not None:
+        settings['enabled'] = enabled
+    if directory:
+        settings['directory'] = directory
+    if max_bytes:
+        settings['max_bytes'] = int(max_bytes)
+    if metadata_ttl is not None:
+        settings['metadata_ttl'] = int(metadata_ttl)
+
+
+def is_url(location):
+    return location.startswith(('http://', 'https://'))
+
+
+def fetch(url):
+    '''
+    Returns the path of an up to date local copy of url, downloading it in
+    chunks if it isn't cached or has changed. Returns None when the cache is
+    disabled.
+    '''
+    if not settings['enabled']:
+        return None
+    stream = open_url(url)
+    try:
+        while stream.read(CHUNK_SIZE):
+            pass
+    finally:
+        stream.close()
+    return _paths(url)[0]
+
+
+def local_path(location):
+    '''
+    Returns a cached local path for a URL, or location itself for local
+    files or when the cache is disabled.
+    '''
+    if is_url(location):
+        return fetch(location) or location
+    return location
+
+
+def get(url):
+    '''
+    Returns the body of url, from the cache if it is still current.
+    '''
+    stream = open_url(url)
+    try:
+        return stream.read()
+    finally:
+        stream.close()
+
+
+def get_metadata(key, fetch):
+    '''
+    Returns the metadata saved under key, calling fetch() for it only if it
+    hasn't been fetched by this process and, with the cache enabled, wasn't
+    saved to disk within the last metadata_ttl seconds. The value must be
+    JSON serializable.
+    '''
+    with _lock:
+        if key in _metadata:
+            return _metadata[key]
+    path = _metadata_path(key)
+    on_disk = settings['enabled'] and settings['metadata_ttl'] > 0
+    value = None
+    if on_disk and os.path.exists(path) and \
+            time.time() - os.path.getmtime(path) < settings['metadata_ttl']:
+        value = (_read_meta(path) or {}).get('value')
+    if value is None:
+        value = fetch()
+        if on_disk:
+            os.makedirs(settings['directory'], exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=settings['directory'])
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'key': key, 'value': value}, f)
+            os.replace(tmp_path, path)
+    with _lock:
+        _metadata[key] = value
+    return value
+
+
+def get_json(url, keys=None):
+    '''
+    Returns the parsed JSON response of url as metadata (see get_metadata).
+    If keys is given only those top level keys of the response are kept.
+    '''
+    def fetch():
+        response = requests.get(url)
+        response.raise_for_status()
+        value = response.json()
+        if keys:
+            value = {key: value[key] for key in keys if key in value}
+        return value
+    return get_metadata(url, fetch)
+
+
+def get_frame(key, fetch):
+    '''
+    Returns the DataFrame saved under key, calling fetch() for it only if it
+    isn't in the cache. Saved frames are evicted like downloaded files.
+    '''
+    if not settings['enabled']:
+        return fetch()
+    path = _paths(key)[0]
+    if os.path.exists(path):
+        try:
+            df = pd.read_pickle(path)
+            os.utime(path, None)
+            return df
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+            os.remove(path)
+    df = fetch()
+    os.makedirs(settings['directory'], exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=settings['directory'])
+    os.close(fd)
+    df.to_pickle(tmp_path)
+    os.replace(tmp_path, path)
+    _evict(keep=path)
+    return df
+
+
+def open_url(url):
+    '''
+    Opens url as a binary stream. With the cache enabled an unchanged cached
+    copy is read from disk; otherwise the response is saved to the cache as
+    it is read, and only kept once it has been read to the end.
+    '''
+    if not settings['enabled']:
+        return urllib.request.urlopen(url)
+
+    data_path, meta_path = _paths(url)
+    meta = _read_meta(meta_path) if os.path.exists(data_path) else None
+    headers = {}
+    if meta and meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta and meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+
+    try:
+        response = requests.get(url, headers=headers, stream=True)
+    except requests.ConnectionError:
+        if not meta:
+            raise
+        ui.item('Unable to reach %s; using cached copy' % url)
+        return open(data_path, 'rb')
+    if response.status_code == 304:
+        response.close()
+        ui.item('Using cached copy of %s' % url)
+        os.utime(data_path, None)
+        return open(data_path, 'rb')
+    response.raise_for_status()
+    return _CachingStream(response, url, data_path, meta_path)
+
+
+class _CachingStream:
+    '''
+    Reads a response while copying it into a temporary file, which replaces
+    the cache entry once the whole response has been read.
+    '''
+    def __init__(self, response, url, data_path, meta_path):
+        self.response = response
+        self.raw = response.raw
+        self.raw.decode_content = True
+        self.meta = {'url': url,
+                     'etag': response.headers.get('ETag'),
+                     'last_modified': response.headers.get('Last-Modified')}
+        self.data_path = data_path
+        self.meta_path = meta_path
+        os.makedirs(settings['directory'], exist_ok=True)
+        fd, self.tmp_path = tempfile.mkstemp(dir=settings['directory'])
+        self.tmp = os.fdopen(fd, 'wb')
+        self.complete = False
+
+    def read(self, size=-1):
+        data = self.raw.read(None if size is None or size < 0 else size)
+        if data:
+            self.tmp.write(data)
+        elif not self.complete:
+            self._save()
+        return data
+
+    def _save(self):
+        self.complete = True
+        self.tmp.close()
+        os.replace(self.tmp_path, self.data_path)
+        with open(self.meta_path, 'w') as f:
+            json.dump(self.meta, f)
+        _evict(keep=self.data_path)
+
+    def close(self):
+        self.response.close()
+        if not self.complete:
+            self.tmp.close()
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _paths(url):
+    key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    base = os.path.join(settings['directory'], key)
+    return base + '.data', base + '.json'
+
+
+def _metadata_path(key):
+    key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(settings['directory'], key + '.meta')
+
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _evict(keep=None):
+    '''
+    Deletes the least recently used entries other than keep until the cache
+    fits within max_bytes.
+    '''
+    with _lock:
+        directory = settings['directory']
+        entries = []
+        for name in os.listdir(directory):
+            if name.endswith('.data'):
+                stat = os.stat(os.path.join(directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= settings['max_bytes']:
+                break
+            if os.path.join(directory, name) == keep:
+                continue
+            base = os.path.join(directory, name[:-len('.data')])
+            for path in (base + '.data', base + '.json'):
+                if os.path.exists(path):
+                    os.remove(path)
+            total -= size
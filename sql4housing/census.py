@@ -0,0 +1,214 @@
+'''
+Plans the Census API requests for CenPy sources.
+
+The boundaries of a place at a given level are looked up once through
+cenpy. The requested variables are then split into groups that fit in a
+single API request, fetched several at a time straight from the Census API
+for the geographies within those boundaries, and joined on GEOID. Both
+boundaries and variable groups are cached on disk by product, year, place
+and level, so several tables for the same place share one boundary lookup.
+'''
+from collections import defaultdict
+import threading
+
+import numpy as np
+import pandas as pd
+import requests
+from cenpy import products
+
+from sql4housing import cache
+from sql4housing import fetch
+from sql4housing import ui
+
+# The API allows 50 columns per request, one of which is GEO_ID
+GROUP_SIZE = 49
+# Geographies listed in a single request, as cenpy does
+GEO_CHUNK = 500
+WORKERS = 4
+# Codes the ACS uses in place of an estimate, as listed by cenpy
+ACS_MISSING = [-999999999, -888888888, -666666666, -555555555, -333333333,
+               -222222222]
+
+_lock = threading.Lock()
+_key_locks = defaultdict(threading.Lock)
+_products = {}
+_boundaries = {}
+
+
+def get_product(product, year=None):
+    '''
+    Returns the cenpy product, which reads the product's variable list from
+    the API when it is created, so it is only created once.
+    '''
+    with _lock:
+        if (product, year) not in _products:
+            if product == 'Decennial2010':
+                cen_prod = products.Decennial2010()
+            elif year:
+                cen_prod = products.ACS(year)
+            else:
+                cen_prod = products.ACS()
+            _products[(product, year)] = cen_prod
+        return _products[(product, year)]
+
+
+def get_frame(product, year, place_type, place, level, variables,
+              workers=WORKERS):
+    '''
+    Returns a GeoDataFrame holding the boundaries of every geography at
+    level within place, joined with the requested variables.
+    '''
+    cen_prod = get_product(product, year)
+    key = ('census', product, year, place_type, place, level)
+    boundaries = get_boundaries(cen_prod, key, place_type, place, level)
+    requested = variables
+    variables = expand_variables(cen_prod, variables)
+    if not variables:
+        raise ValueError('No Census variables match %s' % (requested,))
+    groups = plan(variables)
+    queries = geo_queries(boundaries['GEOID'], level)
+    ui.item('Requesting %s variables in %s groups for %s geographies.' % (
+        len(variables), len(groups), boundaries.shape[0]))
+
+    def get_group(group):
+        return cache.get_frame(
+            repr(key + tuple(group)),
+            lambda: query_group(cen_prod, group, queries))
+
+    # The boundaries are shared with later datasets, so they are never
+    # returned or changed themselves
+    df = boundaries.copy()
+    for num, data in enumerate(fetch.prefetch(
+            get_group, groups, workers=workers)):
+        if num:
+            # The geography columns come with the first group
+            data = data[['GEOID'] + [col for col in data.columns
+                                     if col in groups[num]]]
+        df = df.merge(data, how='left', on='GEOID')
+    return df
+
+
+def get_boundaries(cen_prod, key, place_type, place, level):
+    '''
+    Looks up the GEOID and geometry of every geography at level within
+    place through cenpy, once per place and level for the process and, with
+    the cache enabled, across runs.
+    '''
+    key = repr(key + ('boundaries',))
+    place_mapper = {'msa': cen_prod.from_msa,
+                    'csa': cen_prod.from_csa,
+                    'county': cen_prod.from_county,
+                    'state': cen_prod.from_state,
+                    'placename': cen_prod.from_place}
+
+    def lookup():
+        ui.item('Looking up %s boundaries in %s.' % (level, place))
+        df = place_mapper[place_type](place, level=level, variables=[])
+        return df[['GEOID', df.geometry.name]]
+
+    # Datasets loading at the same time wait for a single lookup
+    with _key_locks[key]:
+        if key not in _boundaries:
+            _boundaries[key] = cache.get_frame(key, lookup)
+        return _boundaries[key]
+
+
+def expand_variables(cen_prod, variables):
+    '''
+    Expands table codes such as B19013 into the variables they contain, in
+    the same way as cenpy.
+    '''
+    if isinstance(variables, str):
+        variables = [variables]
+    expanded = set()
+    for pattern in variables:
+        expanded.update(
+            cen_prod.filter_variables(pattern, engine='regex').index)
+    expanded.discard('GEO_ID')
+    return sorted(expanded)
+
+
+def plan(variables, group_size=GROUP_SIZE):
+    '''
+    Splits variables into groups that each fit in one request.
+    '''
+    return [variables[start:start + group_size]
+            for start in range(0, len(variables), group_size)]
+
+
+def geo_queries(geoids, level):
+    '''
+    Returns the (for, in) clauses of the requests covering geoids, at most
+    GEO_CHUNK geographies each.
+    '''
+    geoids = pd.Series(sorted(set(geoids)))
+    queries = []
+    if level == 'county':
+        for state, group in geoids.groupby(geoids.str[:2]):
+            for chunk in _chunks(group.str[2:5].unique()):
+                queries.append(('county:' + ','.join(chunk),
+                                {'state': state}))
+    elif level in ('tract', 'block'):
+        for (state, county), group in geoids.groupby(
+                [geoids.str[:2], geoids.str[2:5]]):
+            for chunk in _chunks(group.str[5:11].unique()):
+                if level == 'tract':
+                    queries.append(('tract:' + ','.join(chunk),
+                                    {'state': state, 'county': county}))
+                else:
+                    queries.append(('block:*',
+                                    {'state': state, 'county': county,
+                                     'tract': ','.join(chunk)}))
+    else:
+        raise ValueError('Unsupported Census level: %s' % level)
+    return queries
+
+
+def _chunks(values, size=GEO_CHUNK):
+    values = list(values)
+    return [values[start:start + size]
+            for start in range(0, len(values), size)]
+
+
+def query_group(cen_prod, group, queries):
+    '''
+    Requests a group of variables for every geography in queries and
+    returns them with a GEOID column. Variables are converted to numbers
+    where possible, with ACS missing value codes replaced by NaN, as cenpy
+    does.
+    '''
+    data = pd.concat(
+        [query(cen_prod, group + ['GEO_ID'], geo_unit, geo_filter)
+         for geo_unit, geo_filter in queries],
+        ignore_index=True, sort=False)
+    data['GEOID'] = data['GEO_ID'].str.split('US').str[1]
+    for variable in group:
+        values = pd.to_numeric(data[variable], errors='coerce')
+        # Leave text variables, such as NAME, as they are
+        if values.notna().sum() == data[variable].notna().sum():
+            data[variable] = values.replace(ACS_MISSING, np.nan)
+    return data.drop(columns=['GEO_ID'])
+
+
+def query(cen_prod, cols, geo_unit, geo_filter):
+    '''
+    Makes a single Census API request, retrying on failure. cenpy's own
+    query isn't safe to call from several threads at once.
+    '''
+    # The product's API connection knows the endpoint and any API key
+    api = cen_prod._api
+    params = {'get': ','.join(cols), 'for': geo_unit,
+              'in': ' '.join('%s:%s' % item for item in geo_filter.items())}
+    if getattr(api, 'apikey', ''):
+        params['key'] = api.apikey
+
+    def request():
+        response = requests.get(
+            api.cxn.rstrip('?'), params=params, timeout=300)
+        response.raise_for_status()
+        if response.status_code == 204:
+            # No geographies matched
+            return pd.DataFrame(columns=cols)
+        rows = response.json()
+        return pd.DataFrame.from_records(rows[1:], columns=rows[0])
+    return fetch.retry(request)
@@ -5,20 +5,21 @@ into a SQL database. The loader supports any database supported by SQLalchemy.
 This file is adapted from a forked copy of DallasMorningNews/socrata2sql
 
 Usage:
-  sql4housing bulk_load
-  sql4housing hud <site> [--d=<database_url>] [--t=<table_name>]
-  sql4housing socrata <site> <dataset_id> [--a=<app_token>] [--d=<database_url>] [--t=<table_name>]
-  sql4housing csv <location> [--d=<database_url>] [--t=<table_name>]
-  sql4housing excel <location> [--d=<database_url>] [--t=<table_name>]
-  sql4housing shp <location> [--d=<database_url>] [--t=<table_name>]
-  sql4housing geojson <location> [--d=<database_url>] [--t=<table_name>]
-  sql4housing census (decennial2010 | (acs [--y=<year>])) <variables> (--m=<msa> | --c=<csa> | --n=<county> | --s=<state> | --p=<place>) [--l=<level>] [--d=<database_url>] [--t=<table_name>]
+  sql4housing bulk_load [--resume] [--swap] [--analyze] [--cache | --no-cache] [--cache-dir=<dir>] [--metadata-ttl=<s>]
+  sql4housing hud <site> [--workers=<n>] [--resume] [--d=<database_url>] [--t=<table_name>] [--commit-rows=<n>] [--commit-mb=<mb>] [--swap] [--index=<columns>] [--analyze] [--cache | --no-cache] [--cache-dir=<dir>] [--metadata-ttl=<s>]
+  sql4housing socrata <site> <dataset_id> [--a=<app_token>] [--page-size=<rows>] [--workers=<n>] [--keyset] [--incremental] [--resume] [--d=<database_url>] [--t=<table_name>] [--commit-rows=<n>] [--commit-mb=<mb>] [--swap] [--index=<columns>] [--analyze] [--cache | --no-cache] [--cache-dir=<dir>] [--metadata-ttl=<s>]
+  sql4housing csv <location> [--chunksize=<rows>] [--d=<database_url>] [--t=<table_name>] [--commit-rows=<n>] [--commit-mb=<mb>] [--swap] [--index=<columns>] [--analyze] [--cache | --no-cache] [--cache-dir=<dir>] [--metadata-ttl=<s>]
+  sql4housing excel <location> [--d=<database_url>] [--t=<table_name>] [--commit-rows=<n>] [--commit-mb=<mb>] [--swap] [--index=<columns>] [--analyze] [--cache | --no-cache] [--cache-dir=<dir>] [--metadata-ttl=<s>]
+  sql4housing shp <location> [--d=<database_url>] [--t=<table_name>] [--commit-rows=<n>] [--commit-mb=<mb>] [--swap] [--index=<columns>] [--analyze] [--cache | --no-cache] [--cache-dir=<dir>] [--metadata-ttl=<s>]
+  sql4housing geojson <location> [--sample-rows=<n>] [--scan-rows=<n>] [--d=<database_url>] [--t=<table_name>] [--commit-rows=<n>] [--commit-mb=<mb>] [--swap] [--index=<columns>] [--analyze] [--cache | --no-cache] [--cache-dir=<dir>] [--metadata-ttl=<s>]
+  sql4housing census (decennial2010 | (acs [--y=<year>])) <variables> (--m=<msa> | --c=<csa> | --n=<county> | --s=<state> | --p=<place>) [--l=<level>] [--d=<database_url>] [--t=<table_name>] [--commit-rows=<n>] [--commit-mb=<mb>] [--swap] [--index=<columns>] [--analyze] [--cache | --no-cache] [--cache-dir=<dir>] [--metadata-ttl=<s>]
   sql4housing (-h | --help)
   sql4housing (-v | --version)
 
 Options:
   <bulk_load>        Loads all datasets documented within a file entitled bulk_load.yaml.
                      Must be run in the same folder where bulk_load.yaml is saved.
+                     Datasets are loaded WORKERS at a time as set in the file.
   <site>             The domain for the open data site. For Socrata, this is the
                      URL to the open data portal (Ex: www.dallasopendata.com).
                      For HUD, this is the Query URL as created in the API
@@ -39,6 +40,51 @@ Options:
                      version of the dataset or file's name.
   --a=<app_token>    App token for the Socrata site. Only necessary for
                      high-volume requests. Default: None
+  --page-size=<rows> Number of rows requested per Socrata API call.
+                     Default: 5000
+  --workers=<n>      Number of Socrata or HUD pages downloaded at the same
+                     time while earlier pages are written to the database.
+                     HUD pages hold the layer's maxRecordCount features.
+                     Default: 4
+  --keyset           Page through the Socrata dataset ordered by its :id
+                     system field instead of by offset. Recommended for very
+                     large datasets.
+  --incremental      Keep the destination table between runs and only fetch
+                     Socrata rows updated since the last run, upserting them
+                     on the row's :id. The first run loads the whole dataset.
+  --resume           Continue an interrupted Socrata or HUD load from the
+                     last commit (see --commit-rows) instead of dropping
+                     the table and starting over. For bulk_load this is the
+                     same as RESUME: true in bulk_load.yaml.
+  --chunksize=<rows> Stream the csv in chunks of this many rows instead of
+                     reading the whole file into memory. The table schema is
+                     inferred from the first rows and widened if later chunks
+                     disagree.
+  --sample-rows=<n>  Number of GeoJSON features, picked at random, whose
+                     values are used to work out the column types.
+                     Default: 1000
+  --scan-rows=<n>    Number of GeoJSON features read to pick the sample
+                     from. They are held in memory until they are loaded.
+                     Default: 100000
+  --commit-rows=<n>  Commit every n rows instead of once at the end, so long
+                     loads hold a bounded transaction and keep the rows
+                     already committed if they fail. 0 commits only at the
+                     end. Default: 100000
+  --commit-mb=<mb>   Also commit once this many megabytes have been written
+                     since the last commit. 0 disables. Default: 100
+  --swap             Load into a shadow table named <table_name>__loading
+                     and swap it in place of the destination table in one
+                     transaction once it is complete, so the old table
+                     stays readable for the whole load. Incremental
+                     Socrata loads ignore it. For bulk_load this is the same
+                     as SWAP: true in bulk_load.yaml.
+  --index=<columns>  Comma separated columns to build B-tree indexes on once
+                     the rows are loaded. Geometry columns always get a GiST
+                     index when PostGIS is installed. In bulk_load.yaml,
+                     list the columns per table under INDEXES.
+  --analyze          Run ANALYZE on the table after it is loaded and
+                     indexed. For bulk_load this is the same as
+                     ANALYZE: true in bulk_load.yaml.
   --y=<year>         Optional year specification for the 5-year American Community
                      survey. Defaults to 2017.
   --m=<msa>          The metropolitan statistical area to include. 
@@ -54,6 +100,19 @@ Options:
   --l=<level>        The geographic level at which to extract data. i.e. tract,
                      block, county, region, division. Reference cenpy documentation
                      to learn more: https://github.com/cenpy-devs/cenpy
+  --cache            Keep downloaded files and API responses in a local cache
+                     and only download them again once they have changed.
+                     This is the default.
+  --no-cache         Always download everything from the source.
+  --cache-dir=<dir>  Directory for the download cache. Defaults to the
+                     SQL4HOUSING_CACHE_DIR environment variable or
+                     ~/.cache/sql4housing. The cache is limited to
+                     SQL4HOUSING_CACHE_MB megabytes (default 5120).
+  --metadata-ttl=<s> Seconds for which Socrata and HUD dataset metadata
+                     (names, columns and row counts) is reused from the
+                     cache without asking the server again. 0 always asks.
+                     Defaults to the SQL4HOUSING_METADATA_TTL environment
+                     variable or 86400 (one day).
   -h --help          Show this screen.
   -v --version       Show version.
 
@@ -72,16 +131,16 @@ Examples:
   Load Public Housing Physical Inspection scores into a PostgreSQL database called housingdb:
   $ sql4housing excel "http://www.huduser.org/portal/datasets/pis/public_housing_physical_inspection_scores.xlsx" -d=postgresql:///housingdb
 """
+import copy
+import time
 import warnings
 from docopt import docopt
 from progress.bar import FillingCirclesBar
-from sqlalchemy import Column, create_engine
-from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy import Column
+from sqlalchemy.exc import ProgrammingError
 from sqlalchemy.ext.declarative import declarative_base
 from geoalchemy2.types import Geometry
-from sqlalchemy.orm import sessionmaker
 from sqlalchemy.types import Integer
-from sqlalchemy_utils import database_exists, create_database
 import yaml
 from yaml import CLoader as Loader
 from requests.exceptions import SSLError
@@ -90,6 +149,11 @@ from sql4housing import source_classes as sc
 from sql4housing import ui
 from sql4housing.exceptions import CLIError
 from sql4housing import utils
+from sql4housing import state
+from sql4housing import scheduler
+from sql4housing import connections
+from sql4housing import cache
+from sql4housing import bulk
 
 
 def get_binding(source):
@@ -114,14 +178,9 @@ def get_binding(source):
     for col_name, col_type in source.metadata:
 
         if isinstance(col_type, type(Geometry())) and not source.geo:
-            try:
-                source.session.execute("CREATE EXTENSION POSTGIS;")
-                ui.item(
-                    "Adding PostGIS extension to support %s column." \
-                    % col_name)
-                source.session.commit()
-                source.geo = True
-            except:
+            source.geo = connections.get_database(
+                source.db_name).create_postgis()
+            if not source.geo:
                 msg = (
                     '"%s" is a %s column but your database doesn\'t support '
                     'PostGIS so it\'ll be skipped.'
@@ -140,41 +199,30 @@ def get_binding(source):
 
             assert (col_type), 'Unable to map %s type to a SQL type.' % (
                 source.name)
+            if isinstance(col_type, type(Geometry())):
+                # Spatial indexes are built after the load by
+                # utils.build_indexes
+                col_type = copy.copy(col_type)
+                col_type.spatial_index = False
             record_fields[col_name] = Column(col_type)
 
         except NotImplementedError as e:
             ui.item('%s' % str(e))
 
     source.binding = type('DataRecord', (declarative_base(),), record_fields)
+    utils.get_converter(source.binding)
 
 
 def get_connection(source):
     '''
-    Get a DB connection from the CLI args or defaults to postgres:///mydb
-
+    Get a DB connection from the CLI args or defaults to postgres:///mydb.
+    Engines are shared by every source loading into the same database.
     '''
-    source.engine = create_engine(source.db_name)
     ui.header('Connecting to database %s' % source.db_name)
-
-    if not database_exists(source.engine.url):
-        create_database(source.engine.url)
-        ui.item("Creating database %s" % source.db_name)
-
-    Session = sessionmaker()
-    Session.configure(bind=source.engine)
-
-    source.session = Session()
-
-    gis_q = 'SELECT PostGIS_version();'
-    # Check for PostGIS support
-    try:
-        source.session.execute(gis_q)
-        source.geo = True
-    except OperationalError:
-        source.geo = False
-    except ProgrammingError:
-        source.geo = False
-    source.session.commit()
+    database = connections.get_database(source.db_name)
+    source.engine = database.engine
+    source.session = database.Session()
+    source.geo = database.geo
 
     if source.geo:
         ui.item(
@@ -182,43 +230,113 @@ def get_connection(source):
             'as PostGIS geoms.')
 
 
-def insert_source(source):
-    '''
-    Gets the connection and binding and inserts data.
+def insert_source(source, commit_rows=bulk.COMMIT_ROWS,
+                  commit_mb=bulk.COMMIT_MB, resume=False, swap=False,
+                  indexes=(), analyze=False):
     '''
+    Gets the connection, describes the source, creates the binding and
+    inserts data. The session is committed every commit_rows rows or
+    commit_mb megabytes as it loads.
 
-    get_connection(source)
+    Socrata and HUD loads save the number of rows committed as a checkpoint
+    with each commit. With resume, an existing table with a checkpoint is
+    kept and the load continues from there.
 
-    if not isinstance(source, sc.CenPy):
-        get_binding(source)
+    With swap, rows are loaded into a shadow table which then replaces the
+    destination table in a single transaction.
 
-    if source.engine.dialect.has_table(source.engine, source.tbl_name):
+    Once the rows are loaded, indexes are built on geometry columns and on
+    the columns in indexes, followed by ANALYZE if analyze is set.
+
+    The session is rolled back if the load fails and always closed, so a
+    failed load doesn't keep its connection or table locks.
+    '''
+
+    get_connection(source)
+    try:
+        return _load_source(
+            source, commit_rows, commit_mb, resume, swap, indexes, analyze)
+    except:
+        source.session.rollback()
+        raise
+    finally:
+        source.session.info.pop('commit_policy', None)
+        source.session.close()
+
+
+def _load_source(source, commit_rows, commit_mb, resume, swap, indexes,
+                 analyze):
+    source.describe()
+    source.session.info['commit_policy'] = bulk.CommitPolicy(
+        commit_rows, commit_mb)
+
+    live_name = source.tbl_name
+    swap = swap and not (
+        isinstance(source, sc.SocrataPortal) and source.incremental)
+    if swap:
+        source.tbl_name = live_name + utils.SHADOW_SUFFIX
+        ui.item('Loading into shadow table "%s".' % source.tbl_name)
+
+    get_binding(source)
+
+    table_exists = source.engine.dialect.has_table(
+        source.engine, source.tbl_name)
+
+    syncing = False
+    if isinstance(source, sc.SocrataPortal) and source.incremental:
+        syncing = source.start_sync(table_exists)
+
+    resumable = isinstance(source, (sc.SocrataPortal, sc.HudPortal)) \
+        and not syncing
+    checkpoint = state.get_state(
+        source.session, source.tbl_name, 'checkpoint') \
+        if resumable and resume and table_exists else None
+    if checkpoint:
+        source.resume(int(checkpoint))
+        ui.item('Resuming load after %s rows.' % checkpoint)
+    if resumable:
+        source.session.info['commit_policy'].checkpoint = source.checkpoint
+
+    if table_exists and not syncing and not checkpoint:
         print()
         warnings.warn(("Destination table already exists. Current table " +
                        "will be dropped and replaced."))
         print()
-        if not isinstance(source, sc.CenPy):
-            source.binding.__table__.drop(source.engine)
+        state.clear_state(source.session, source.tbl_name)
+        source.binding.__table__.drop(source.session.connection())
 
 
     try:
-        if not isinstance(source, sc.CenPy):
-            source.binding.__table__.create(source.engine)
+        if not syncing and not checkpoint:
+            source.binding.__table__.create(source.session.connection())
     except ProgrammingError as e:
 
         raise CLIError('Error creating destination table: %s' % str(e))
 
 
     circle_bar = FillingCirclesBar(
-        '  ▶ Loading from source', max=source.num_rows)
+        '  ▶ Loading from source', max=source.num_rows or 1)
+    if checkpoint:
+        circle_bar.goto(source.resume_from)
 
     source.insert(circle_bar)
 
     circle_bar.finish()
 
+    utils.build_indexes(
+        source.session, source.binding.__table__, indexes, analyze)
+
     ui.item(
         'Committing rows (this can take a bit for large datasets).'
     )
+    if resumable:
+        for key in ('checkpoint', 'last_id'):
+            state.clear_state(source.session, source.tbl_name, key)
+    if swap:
+        ui.item('Swapping "%s" in place of "%s".' % (
+            source.tbl_name, live_name))
+        utils.swap_table(source.session, source.tbl_name, live_name)
+        source.tbl_name = live_name
     source.session.commit()
 
     success = 'Successfully imported %s rows.' % (
@@ -228,12 +346,27 @@ def insert_source(source):
     if source.name == "Socrata" and source.client:
         source.client.close()
 
-    return
+    return source.num_rows
 
-def load_yaml():
+def load_yaml(resume=False, swap=False, analyze=False):
     output = yaml.load(open('bulk_load.yaml'), Loader=Loader)
 
     db_name = output['DATABASE']
+    csv_chunksize = output.get('CSV_CHUNKSIZE')
+    geojson_sample_rows = output.get('GEOJSON_SAMPLE_ROWS')
+    geojson_scan_rows = output.get('GEOJSON_SCAN_ROWS')
+    hud_workers = output.get('HUD_WORKERS') or 4
+    jobs = []
+
+    def add_job(name, build, host=None, tbl_name=None):
+        def build_source():
+            source = build()
+            if tbl_name:
+                source.tbl_name = tbl_name
+            if db_name:
+                source.db_name = db_name
+            return source
+        jobs.append(scheduler.Job(name, build_source, host))
 
     source_mapper = {'GEOJSONS': sc.GeoJson,
               'SHAPEFILES': sc.Shape,
@@ -244,15 +377,23 @@ def load_yaml():
     def parse_items(output_dict):
         try:
 
-            for dataset in output[output_dict]:
+            for dataset in output[output_dict] or []:
                 if dataset:
                     location, tbl_name = list(dataset.items())[0]
-                    source = source_mapper[output_dict](location)
-                    if tbl_name:
-                        source.tbl_name = tbl_name
-                    if db_name:
-                        source.db_name = db_name
-                    insert_source(source)
+                    if output_dict == 'CSVS':
+                        build = lambda location=location: \
+                            sc.Csv(location, csv_chunksize)
+                    elif output_dict == 'GEOJSONS':
+                        build = lambda location=location: sc.GeoJson(
+                            location, geojson_sample_rows, geojson_scan_rows)
+                    elif output_dict == 'HUD_TABLES':
+                        build = lambda location=location: \
+                            sc.HudPortal(location, hud_workers)
+                    else:
+                        build = lambda location=location, \
+                            cls=source_mapper[output_dict]: cls(location)
+                    add_job(tbl_name or location, build,
+                            scheduler.get_host(location), tbl_name)
                 else:
                     continue
         except Exception as e:
@@ -269,18 +410,21 @@ def load_yaml():
     try:
         socrata_sites = output.get('SOCRATA').get('sites')
         app_token = output.get('SOCRATA').get('app_token')
+        page_size = output.get('SOCRATA').get('page_size') or 5000
+        workers = output.get('SOCRATA').get('workers') or 4
+        keyset = bool(output.get('SOCRATA').get('keyset'))
+        incremental = bool(output.get('SOCRATA').get('incremental'))
         if socrata_sites:
             for site in socrata_sites:
                 url = site['url']
                 for dataset in site['datasets']:
                     dataset_id, tbl_name = list(dataset.items())[0]
-                    source = sc.SocrataPortal(
-                        url, dataset_id, app_token, tbl_name)
-                    if db_name:
-                        source.db_name = db_name
-                    if tbl_name:
-                        source.tbl_name = tbl_name
-                    insert_source(source)
+                    build = lambda url=url, dataset_id=dataset_id, \
+                        tbl_name=tbl_name: sc.SocrataPortal(
+                            url, dataset_id, app_token, tbl_name,
+                            page_size=page_size, workers=workers,
+                            keyset=keyset, incremental=incremental)
+                    add_job(tbl_name or dataset_id, build, url, tbl_name)
     except Exception as e:
         ui.item(("Skipping Socrata load due to error: \"%s\". Double check " +
             "formatting of bulk_load.yaml if this is was " +
@@ -302,29 +446,50 @@ def load_yaml():
             year = dataset[product].get('year')  
             tbl_name = dataset[product]['tbl_name']
             variables = dataset[product]['variables']
-            source = sc.CenPy(
-                product, year, place_type, place_name, level, variables)
-            if db_name:
-                source.db_name = db_name
-            if tbl_name:
-                source.tbl_name = tbl_name
-            insert_source(source)
+            build = lambda product=product, year=year, \
+                variables=variables: sc.CenPy(
+                    product, year, place_type, place_name, level, variables)
+            add_job(tbl_name or product, build, 'api.census.gov', tbl_name)
     except Exception as e:        
         ui.item(("Skipping Census load due to error: \"%s\". Double check " +
             "formatting of bulk_load.yaml if this was unintentional.") % e)
         print()
         pass
 
+    indexes = output.get('INDEXES') or {}
+
+    def insert(source):
+        return insert_source(
+            source,
+            commit_rows=output.get('COMMIT_ROWS', bulk.COMMIT_ROWS),
+            commit_mb=output.get('COMMIT_MB', bulk.COMMIT_MB),
+            resume=resume or bool(output.get('RESUME')),
+            swap=swap or bool(output.get('SWAP')),
+            indexes=indexes.get(source.tbl_name) or (),
+            analyze=analyze or bool(output.get('ANALYZE')))
+
+    start = time.time()
+    scheduler.Scheduler(
+        insert, output.get('WORKERS'),
+        output.get('WORKERS_PER_HOST')).run(jobs)
+    scheduler.report(jobs, time.time() - start)
+    connections.dispose_all()
+
 
 def main():
 
     arguments = docopt(__doc__)
+    cache.configure(
+        enabled=not arguments['--no-cache'],
+        directory=arguments['--cache-dir'],
+        metadata_ttl=arguments['--metadata-ttl'])
 
     try:
 
         if arguments['bulk_load']:
 
-            load_yaml()
+            load_yaml(arguments['--resume'], arguments['--swap'],
+                      arguments['--analyze'])
 
         else:
 
@@ -333,22 +498,33 @@ def main():
                 source = sc.SocrataPortal(
                     arguments['<site>'], \
                     arguments['<dataset_id>'], \
-                    arguments['--a'])
+                    arguments['--a'], \
+                    page_size=int(arguments['--page-size'] or 5000), \
+                    workers=int(arguments['--workers'] or 4), \
+                    keyset=arguments['--keyset'], \
+                    incremental=arguments['--incremental'])
 
             if arguments['hud']:
-                source = sc.HudPortal(arguments['<site>'])
+                source = sc.HudPortal(
+                    arguments['<site>'],
+                    workers=int(arguments['--workers'] or 4))
 
             if arguments['excel']:
                 source = sc.Excel(arguments['<location>'])
 
             if arguments['csv']:
-                source = sc.Csv(arguments['<location>'])
+                chunksize = int(arguments['--chunksize']) \
+                    if arguments['--chunksize'] else None
+                source = sc.Csv(arguments['<location>'], chunksize)
 
             if arguments['shp']:
                 source = sc.Shape(arguments['<location>'])
 
             if arguments['geojson']:
-                source = sc.GeoJson(arguments['<location>'])
+                source = sc.GeoJson(
+                    arguments['<location>'],
+                    int(arguments['--sample-rows'] or 0),
+                    int(arguments['--scan-rows'] or 0))
 
             if arguments['census']:
                 place_mappings = {'--m': 'msa',
@@ -387,7 +563,19 @@ def main():
 
             assert(source), "Source has not been defined."
 
-            insert_source(source)
+            commit_rows = arguments['--commit-rows']
+            commit_mb = arguments['--commit-mb']
+            insert_source(
+                source,
+                int(commit_rows) if commit_rows is not None \
+                    else bulk.COMMIT_ROWS,
+                float(commit_mb) if commit_mb is not None \
+                    else bulk.COMMIT_MB,
+                arguments['--resume'], arguments['--swap'],
+                arguments['--index'].split(',') if arguments['--index'] \
+                    else (),
+                arguments['--analyze'])
+            connections.dispose_all()
 
     except CLIError as e:
         ui.header(str(e), color='\033[91m')
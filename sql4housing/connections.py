@@ -0,0 +1,84 @@
+'''
+Caches one pooled engine per database URL for the life of the process so
+that connecting, creating the database and probing for PostGIS happen once
+per database rather than once per dataset.
+'''
+import threading
+from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError, OperationalError, ProgrammingError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy_utils import database_exists, create_database
+
+from sql4housing import ui
+
+_lock = threading.Lock()
+_databases = {}
+
+
+class Database:
+    '''
+    A pooled engine plus what has been learned about the database behind it.
+    '''
+    def __init__(self, url):
+        self.url = url
+        self.engine = create_engine(url)
+
+        if not database_exists(self.engine.url):
+            create_database(self.engine.url)
+            ui.item("Creating database %s" % url)
+
+        self.Session = sessionmaker(bind=self.engine)
+        self.geo = self.__has_postgis()
+        self.postgis_tried = False
+
+    def create_postgis(self):
+        '''
+        Adds the PostGIS extension, once for every dataset loading into the
+        database. Returns whether the database supports PostGIS.
+        '''
+        with _lock:
+            if self.geo or self.postgis_tried:
+                return self.geo
+            self.postgis_tried = True
+            session = self.Session()
+            try:
+                session.execute('CREATE EXTENSION IF NOT EXISTS POSTGIS;')
+                session.commit()
+                ui.item('Adding PostGIS extension to support geometries.')
+                self.geo = True
+            except DBAPIError:
+                session.rollback()
+            finally:
+                session.close()
+            return self.geo
+
+    def __has_postgis(self):
+        session = self.Session()
+        try:
+            session.execute('SELECT PostGIS_version();')
+            return True
+        except (OperationalError, ProgrammingError):
+            return False
+        finally:
+            session.rollback()
+            session.close()
+
+
+def get_database(url):
+    '''
+    Returns the cached Database for url, connecting on first use.
+    '''
+    with _lock:
+        if url not in _databases:
+            _databases[url] = Database(url)
+        return _databases[url]
+
+
+def dispose_all():
+    '''
+    Closes every pooled connection and forgets the cached databases.
+    '''
+    with _lock:
+        for database in _databases.values():
+            database.engine.dispose()
+        _databases.clear()
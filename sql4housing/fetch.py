@@ -0,0 +1,87 @@
+'''
+Helpers for downloading pages of remote data concurrently.
+'''
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import queue
+import threading
+import time
+
+import requests
+
+from sql4housing import ui
+
+RETRIES = 5
+RETRY_SECONDS = 10
+
+
+def retry(request, retries=RETRIES):
+    '''
+    Returns request(), calling it again after a pause when it fails with a
+    network error or an unreadable response, up to retries times in all.
+    The last error is raised.
+    '''
+    for attempt in range(retries):
+        try:
+            return request()
+        except (requests.RequestException, ValueError):
+            if attempt == retries - 1:
+                raise
+            ui.item("Sleeping for %s seconds to avoid timeout" %
+                    RETRY_SECONDS)
+            time.sleep(RETRY_SECONDS)
+
+
+def prefetch(fetch, args, workers=4, depth=None, is_last=None):
+    '''
+    Calls fetch(arg) for each of args on a pool of worker threads and yields
+    the results in order. At most depth pages are downloading or waiting to
+    be consumed at any time, so network requests overlap with whatever the
+    caller does with each page without buffering the whole dataset.
+
+    args may be endless; iteration stops at the first result for which
+    is_last(result) is true.
+    '''
+    depth = max(depth or workers * 2, 1)
+    args = iter(args)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque(
+            pool.submit(fetch, arg) for arg in itertools.islice(args, depth))
+        while pending:
+            result = pending.popleft().result()
+            yield result
+            if is_last and is_last(result):
+                for future in pending:
+                    future.cancel()
+                break
+            for arg in itertools.islice(args, 1):
+                pending.append(pool.submit(fetch, arg))
+
+
+def background(iterable, depth=2):
+    '''
+    Iterates over iterable in a worker thread and yields its items in order.
+    At most depth items are buffered, so the producer runs just ahead of the
+    caller. Errors raised by the producer are re-raised to the caller.
+    '''
+    buffer = queue.Queue(maxsize=depth)
+    done = object()
+    failure = []
+
+    def produce():
+        try:
+            for item in iterable:
+                buffer.put(item)
+        except Exception as e:
+            failure.append(e)
+        buffer.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = buffer.get()
+        if item is done:
+            break
+        yield item
+    if failure:
+        raise failure[0]
@@ -1,19 +1,26 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
-from shapely.geometry import shape
-from geomet import wkt
+import shapely
+from shapely import wkb
+from shapely.geometry import Point, shape
+import numpy as np
 import pandas as pd
 
 
 def parse_datetime(str_val, srid=None):
     """Parse a Socrata floating timestamp field into a Python datetime
 
-    See https://dev.socrata.com/docs/datatypes/floating_timestamp.html"""
+    See https://dev.socrata.com/docs/datatypes/floating_timestamp.html
+
+    Numbers are taken as milliseconds since the epoch, which is how ArcGIS
+    layers (HUD) return esriFieldTypeDate fields."""
 
     if type(str_val) == pd.Timestamp:
         return str_val.to_pydatetime()
     if pd.isna(str_val):
         return None
+    if isinstance(str_val, (int, float)) and not isinstance(str_val, bool):
+        return EPOCH + timedelta(milliseconds=str_val)
     if str_val == '' or not str_val:
         return None
     if str_val[-1] == "Z":
@@ -27,27 +34,113 @@ def parse_datetime(str_val, srid=None):
         return datetime.strptime(str_val, "%Y-%m-%dT%H:%M:%S")
 
 
+EPOCH = datetime(1970, 1, 1)
+
+
+# Formats tried, in order, when detecting the format of a datetime column
+DATETIME_FORMATS = [
+    "%Y-%m-%dT%H:%M:%S.%f",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d",
+    "%m/%d/%Y %I:%M:%S %p",
+    "%m/%d/%Y",
+]
+
+
+class DatetimeParser:
+    """
+    Parses a datetime column a batch at a time. The column's format is
+    detected from its first value and reused for every later batch, and each
+    batch is parsed in one vectorized pd.to_datetime call. Values that don't
+    match the format fall back to parse_datetime.
+    """
+    def __init__(self):
+        self.fmt = None
+
+    def __call__(self, values, srid=None):
+        strings = [strip_zone(val) if isinstance(val, str) else None
+                   for val in values]
+        if self.fmt is None:
+            self.fmt = detect_format(strings)
+        if not self.fmt:
+            return [parse_datetime(val) for val in values]
+        parsed = pd.to_datetime(
+            pd.Series(strings, dtype=object), format=self.fmt,
+            errors='coerce')
+        return [parse_datetime(val) if pd.isna(parsed_val)
+                else parsed_val.to_pydatetime()
+                for val, parsed_val in zip(values, parsed)]
+
+
+def strip_zone(str_val):
+    return str_val[:-1] if str_val.endswith("Z") else str_val
+
+
+def detect_format(strings):
+    """
+    Returns the first of DATETIME_FORMATS matching the first string, or None
+    if there are no strings to go on yet.
+    """
+    sample = next((val for val in strings if val), None)
+    if sample is None:
+        return None
+    for fmt in DATETIME_FORMATS:
+        try:
+            datetime.strptime(sample, fmt)
+            return fmt
+        except ValueError:
+            continue
+    return None
+
+
 def parse_geom(geo_data, srid):
     """
+    Encode a GeoJSON geometry or Socrata location as hex EWKB, which PostGIS
+    reads directly both in COPY and through ST_GeomFromEWKT.
+
     TO DO: add code to parse other socrata geometry types
     make parsers object oriented
     """
+    geom = to_shape(geo_data)
+    if geom is None:
+        return None
+    return wkb.dumps(geom, hex=True, srid=int(srid))
+
+
+def parse_geoms(geo_values, srid):
+    """
+    Encode a batch of geometries as hex EWKB. With shapely 2 the encoding is
+    done for the whole batch at once.
+    """
+    if not hasattr(shapely, 'to_wkb'):
+        return [parse_geom(geo_data, srid) for geo_data in geo_values]
+    return encode_geoms([to_shape(geo_data) for geo_data in geo_values], srid)
 
+
+def encode_geoms(geoms, srid):
+    """
+    Encode a sequence of shapely geometries, e.g. a GeoSeries, as hex EWKB.
+    Missing geometries stay None.
+    """
+    if not hasattr(shapely, 'to_wkb'):
+        return [None if geom is None else
+                wkb.dumps(geom, hex=True, srid=int(srid)) for geom in geoms]
+    geoms = shapely.set_srid(np.asarray(geoms, dtype=object), int(srid))
+    return shapely.to_wkb(geoms, hex=True, include_srid=True).tolist()
+
+
+def to_shape(geo_data):
     if geo_data is None:
         return None
-    
+
     if 'latitude' in geo_data and 'longitude' in geo_data:
-        return 'SRID=%s;POINT(%s %s)' % (
-            srid,
-            geo_data['longitude'],
-            geo_data['latitude'],
-        )
+        return Point(
+            float(geo_data['longitude']), float(geo_data['latitude']))
     elif 'human_address' in geo_data and 'latitude' not in geo_data:
         return None
     else:
-        wkt_text = shape(geo_data).wkt
-
-        return ";".join(["SRID=%s" % srid, shape(geo_data).wkt])
+        return shape(geo_data)
 
 def parse_str(raw_str, srid=None):
     if raw_str == "nan":
@@ -0,0 +1,122 @@
+'''
+Runs the datasets of a bulk load in parallel.
+'''
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import threading
+import time
+from urllib.parse import urlparse
+
+from sql4housing import ui
+
+
+class Job:
+    '''
+    One dataset of a bulk load. build is called on a worker to construct the
+    source. Sources don't read anything until they are described, which
+    happens while they are inserted.
+    host is the remote host the dataset comes from, if any, and is used to
+    limit how many datasets are requested from the same server at once.
+    '''
+    def __init__(self, name, build, host=None):
+        self.name = name
+        self.build = build
+        self.host = host
+        self.rows = 0
+        self.seconds = 0
+        self.error = None
+
+
+def get_host(location):
+    '''
+    Returns the host of a download URL or None for local paths.
+    '''
+    return urlparse(location).netloc or None
+
+
+class Scheduler:
+    '''
+    Runs jobs on a pool of workers. At most workers datasets load at once,
+    and at most per_host of them from the same remote host. A job is only
+    handed to a worker once its host has room, so jobs waiting on a busy
+    host don't hold up jobs for other hosts. Datasets going to the same
+    table are loaded one after another.
+    '''
+    def __init__(self, insert, workers=1, per_host=None):
+        self.insert = insert
+        self.workers = max(int(workers or 1), 1)
+        self.per_host = int(per_host) if per_host else None
+        self._lock = threading.Lock()
+        self._host_limits = {}
+        self._table_locks = defaultdict(threading.Lock)
+
+    def run(self, jobs):
+        pending = list(jobs)
+        running = set()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while pending or running:
+                for job in list(pending):
+                    if len(running) >= self.workers:
+                        break
+                    host_limit = self._host_limit(job.host) \
+                        if job.host and self.per_host else None
+                    if host_limit and not host_limit.acquire(blocking=False):
+                        continue
+                    pending.remove(job)
+                    running.add(pool.submit(self._run_job, job, host_limit))
+                # Jobs left pending wait for a running job to finish
+                _, running = wait(running, return_when=FIRST_COMPLETED)
+        return jobs
+
+    def _host_limit(self, host):
+        with self._lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(
+                    self.per_host)
+            return self._host_limits[host]
+
+    def _table_lock(self, source):
+        with self._lock:
+            return self._table_locks[(source.db_name, source.tbl_name)]
+
+    def _run_job(self, job, host_limit=None):
+        '''
+        Loads a job's dataset, releasing host_limit, already acquired by
+        run, once it is done.
+        '''
+        start = time.time()
+        try:
+            try:
+                source = job.build()
+                if not source.tbl_name:
+                    # The default table name comes from the source itself
+                    source.describe()
+                with self._table_lock(source):
+                    job.rows = self.insert(source) or 0
+            finally:
+                if host_limit:
+                    host_limit.release()
+        except Exception as e:
+            # Only the message is kept; the traceback would keep the
+            # source and its session alive until the bulk load ends
+            job.error = str(e) or type(e).__name__
+            ui.item(("Skipping %s load due to error: \"%s\". Double check " +
+                "formatting of bulk_load.yaml if this was " +
+                "unintentional.") % (job.name, e))
+            print()
+        job.seconds = time.time() - start
+        return job
+
+
+def report(jobs, seconds):
+    '''
+    Prints the wall time and throughput of each dataset in a bulk load.
+    '''
+    ui.header('Bulk load finished in %.1fs' % seconds)
+    for job in jobs:
+        if job.error:
+            ui.item('%s: failed after %.1fs' % (job.name, job.seconds))
+            continue
+        ui.item('%s: %s rows in %.1fs (%.0f rows/s)' % (
+            job.name, job.rows, job.seconds,
+            job.rows / job.seconds if job.seconds else 0))
@@ -1,32 +1,47 @@
 '''
 Classes to represent each data source.
 '''
+import urllib.parse
 import urllib.request
-import json
 import re
 from sqlalchemy.types import \
     Boolean, DateTime, Integer, BigInteger, Numeric, Text
+from sqlalchemy import Index
 from geoalchemy2.types import Geometry
-from geopandas_postgis import PostGIS
 from bs4 import BeautifulSoup
 from sodapy import Socrata
-from cenpy import products
 import pandas as pd
 import numpy as np
-import string
 import shapefile
 import zipfile
-import io
+import os
+import shutil
+import tempfile
+import weakref
 import requests
 import time
+import itertools
 import warnings
+from sql4housing import census
 from sql4housing import utils
 from sql4housing import ui
+from sql4housing import fetch
+from sql4housing import state
+from sql4housing import streams
+from sql4housing import cache
+
+CSV_SAMPLE_ROWS = 10000
+SHAPEFILE_ENDINGS = ('.shp', '.shx', '.dbf', '.prj')
+CENSUS_BATCH_ROWS = 50000
 
 class Spreadsheet:
     '''
     Parent class of Excel and Csv.
     Uses pandas to read data and interpret data types.
+
+    Like every source, nothing is read when it is constructed. describe()
+    works out the table's columns and iter_batches() yields the data while
+    it is inserted.
     '''
     def __init__(self, location):
         self.location = location
@@ -43,10 +58,17 @@ class Spreadsheet:
         self.engine = None
         self.geo = False
         self.binding = None
-        self.data = None
+        self.metadata = None
+        self.num_rows = None
+        self.srid = 4326
 
     def insert(self, circle_bar):
-        utils.insert_data(self.data, self.session, circle_bar, self.binding)
+        rows_written = 0
+        for df in self.iter_batches():
+            utils.widen_columns(self, df)
+            rows_written += utils.insert_frame(
+                df, self.session, circle_bar, self.binding, srid=self.srid)
+        self.num_rows = rows_written
 
 class Excel(Spreadsheet):
     '''
@@ -56,27 +78,77 @@ class Excel(Spreadsheet):
     '''
     def __init__(self, location):
         Spreadsheet.__init__(self, location)
-        self.xls = pd.ExcelFile(location)
-        self.df = utils.edit_columns(self.xls.parse())
         self.name = "Excel File"
-        self.tbl_name = self.xls.sheet_names[0].lower()
-        self.metadata = utils.spreadsheet_metadata(self)
-        self.num_rows = self.df.shape[0]
-        self.data = self.df.to_dict(orient='records')
+        self.tbl_name = None
+
+    def describe(self):
+        '''
+        Reads the first sheet and interprets its data types.
+        '''
+        if self.metadata is None:
+            xls = pd.ExcelFile(cache.local_path(self.location))
+            self.df = utils.edit_columns(xls.parse())
+            self.tbl_name = self.tbl_name or xls.sheet_names[0].lower()
+            self.metadata = utils.spreadsheet_metadata(self)
+            self.num_rows = self.df.shape[0]
+        return self.metadata
+
+    def iter_batches(self):
+        self.describe()
+        yield self.df
 
 class Csv(Spreadsheet):
     '''
     Stores csv file data.
     Defaults to a sanitized version of the hyperlink or path as the table name.
+    If chunksize is given, the file is streamed in chunks of that many rows
+    and the schema is inferred from a sample of the first rows.
     '''
-    def __init__(self, location):
+    def __init__(self, location, chunksize=None):
         Spreadsheet.__init__(self, location)
-        self.df = pd.read_csv(location)
         self.name = "CSV file"
         self.tbl_name = self.__create_tbl_name()
-        self.metadata = utils.spreadsheet_metadata(self)
-        self.num_rows = self.df.shape[0]
-        self.data = self.df.to_dict(orient='records')
+        self.chunksize = chunksize
+
+    def describe(self):
+        '''
+        Downloads the file if needed and interprets its data types, from a
+        sample of CSV_SAMPLE_ROWS rows when it is read in chunks.
+        '''
+        if self.metadata is None:
+            self.path = cache.local_path(self.location)
+            if self.chunksize:
+                self.df = pd.read_csv(self.path, nrows=CSV_SAMPLE_ROWS)
+                self.metadata = utils.spreadsheet_metadata(self)
+                self.num_rows = self.__count_rows()
+            else:
+                self.df = pd.read_csv(self.path)
+                self.metadata = utils.spreadsheet_metadata(self)
+                self.num_rows = self.df.shape[0]
+        return self.metadata
+
+    def iter_batches(self):
+        self.describe()
+        if not self.chunksize:
+            yield self.df
+            return
+        # Only the sample was read by describe()
+        self.df = None
+        for chunk in pd.read_csv(self.path, chunksize=self.chunksize):
+            yield chunk
+
+    def __count_rows(self):
+        '''
+        Counts lines in a local file to size the progress bar without parsing
+        it. Remote files are not counted.
+        '''
+        try:
+            with open(self.path, 'rb') as f:
+                lines = sum(buf.count(b'\n') for buf in \
+                    iter(lambda: f.read(1 << 20), b''))
+        except (IOError, OSError):
+            return None
+        return max(lines - 1, 0)
 
     def __create_tbl_name(self):
 
@@ -103,12 +175,21 @@ class SpatialFile:
         self.geo = None
         self.binding = None
         self.db_name = "postgresql:///mydb"
+        self.metadata = None
+        self.num_rows = None
         self.col_mappings = {
             str: Text,
             int : Integer,
             float: Numeric,
             bool: Boolean}
 
+    def insert(self, circle_bar):
+        rows_written = 0
+        for batch in self.iter_batches():
+            rows_written += utils.insert_data(
+                batch, self.session, circle_bar, self.binding)
+        self.num_rows = rows_written
+
 class Shape(SpatialFile):
     '''
     Stores shapefile data.
@@ -116,64 +197,118 @@ class Shape(SpatialFile):
     def __init__(self, location):
         SpatialFile.__init__(self, location)
         self.name = "Shapefile"
-        self.tbl_name, self.geojson = self.__extract_file()
-        self.data = utils.geojson_data(self.geojson)
-        self.metadata = utils.create_metadata(self.data, self.col_mappings)
-        self.num_rows = len(self.data)
+        self.tbl_name = None
+        self.reader = None
+
+    def describe(self):
+        '''
+        Downloads and extracts the shapefile and reads its fields.
+        '''
+        if self.metadata is None:
+            tbl_name, self.reader = self.__extract_file()
+            self.tbl_name = self.tbl_name or tbl_name
+            self.metadata = utils.shapefile_metadata(self.reader)
+            self.num_rows = len(self.reader)
+        return self.metadata
+
+    def iter_batches(self):
+        self.describe()
+        try:
+            for batch in utils.batches(utils.shapefile_rows(self.reader)):
+                yield batch
+        finally:
+            self.reader.close()
+            self._cleanup()
 
     def __extract_file(self):
         '''
         Extracts data from zip files if a hyperlink is provided and reads
         the saved shp file. Creates the default table name using a sanitized
         version of the file's name.
-        '''
-        try:
-            z = zipfile.ZipFile(io.BytesIO(requests.get(self.location).content))
-            ui.item("Extracting shapefile to folder")
-            z.extractall()
-            shp = [y for y in sorted(z.namelist()) for ending in \
-            ['dbf', 'prj', 'shp', 'shx'] if y.endswith(ending)][2]
 
-        except:
-            shp = self.location
+        Remote zips are streamed to disk rather than read into memory, and
+        only the members making up the shapefile are extracted, into a
+        temporary folder that is removed after the insert.
+        '''
+        tmp_dir = tempfile.mkdtemp(prefix='sql4housing_')
+        self._cleanup = weakref.finalize(self, shutil.rmtree, tmp_dir, True)
+
+        if cache.is_url(self.location):
+            ui.item("Downloading shapefile")
+            zip_path = cache.fetch(self.location) or \
+                streams.download(self.location, tmp_dir)
+        elif zipfile.is_zipfile(self.location):
+            zip_path = self.location
+        else:
+            zip_path = None
+
+        if zip_path:
+            with zipfile.ZipFile(zip_path) as z:
+                ui.item("Extracting shapefile to temporary folder")
+                shp = sorted(name for name in z.namelist() \
+                    if name.lower().endswith('.shp'))[0]
+                for name in z.namelist():
+                    stem, ending = os.path.splitext(name)
+                    if stem == shp[:-4] and ending.lower() in \
+                            SHAPEFILE_ENDINGS:
+                        z.extract(name, tmp_dir)
+            if zip_path.startswith(tmp_dir):
+                # Uncached download; the extracted members are all we need
+                os.remove(zip_path)
+            shp_path = os.path.join(tmp_dir, shp)
+        else:
+            shp = shp_path = self.location
 
         ui.item("Reading shapefile")
         #set default table name
         tbl_name = shp[shp.rfind("/") + 1:-4].lower()
         tbl_name = utils.clean_string(tbl_name)
-        return tbl_name, shapefile.Reader(shp).__geo_interface__
-
-
-    def insert(self, circle_bar):
-        utils.insert_data(
-            self.data, self.session, circle_bar, self.binding)
-        return
+        return tbl_name, shapefile.Reader(shp_path)
 
 class GeoJson(SpatialFile):
     '''
     Stores geojson data
     '''
-    def __init__(self, location):
+    def __init__(self, location, sample_rows=None, scan_rows=None):
         SpatialFile.__init__(self, location)
         self.name = "GeoJSON"
-        self.data = self.__get_data()
-        self.metadata = utils.create_metadata(self.data, self.col_mappings)
-        self.num_rows = len(self.data)
+        self.stream = None
+        self.sample_rows = sample_rows or utils.SAMPLE_ROWS
+        self.scan_rows = max(scan_rows or utils.SCAN_ROWS, self.sample_rows)
         self.tbl_name = self.__create_tbl_name()
 
-    def insert(self, circle_bar):
-        utils.insert_data(
-            self.data, self.session, circle_bar, self.binding)
-        return
-
-    def __get_data(self):
+    def describe(self):
+        '''
+        Opens the file as a stream of features and reads the first
+        scan_rows of them, working out the column types from a random
+        sample of sample_rows of those. The rest are read while they are
+        inserted, so the number of rows is unknown until then.
+        '''
+        if self.metadata is None:
+            self.scanned, self.data = self.__get_data()
+            self.metadata = utils.create_metadata(
+                self.scanned, self.col_mappings, self.sample_rows,
+                self.scan_rows)
+        return self.metadata
+
+    def iter_batches(self):
+        self.describe()
         try:
-            return utils.geojson_data(json.loads(self.location))
-        except:
-            
-            return utils.geojson_data(
-                json.loads(urllib.request.urlopen(self.location).read()))
+            for batch in utils.batches(
+                    itertools.chain(self.scanned, self.data)):
+                yield batch
+        finally:
+            self.stream.close()
 
+    def __get_data(self):
+        '''
+        Returns the scanned features and an iterator over the rest.
+        '''
+        ui.item(
+            "Gathering data (this can take a bit for large datasets).")
+        self.stream = streams.open_location(self.location)
+        data = utils.geojson_rows(streams.iter_features(self.stream))
+        return list(itertools.islice(data, self.scan_rows)), data
 
     def __create_tbl_name(self):
         '''
@@ -192,50 +327,51 @@ class GeoJson(SpatialFile):
         sub_str = sub_str.group().lower()
         return utils.clean_string(sub_str)
 
-class CenPy:
+class CenPy(Spreadsheet):
     '''
-    Parent class of Shape and GeoJson
+    Stores Census data retrieved with cenpy. The resulting GeoDataFrame is
+    loaded like a spreadsheet, with its geometries written as EWKB.
     '''
     def __init__(self, product, year, place_type, place, level, variables):
+        Spreadsheet.__init__(self, None)
         self.name = product
         self.tbl_name = "_".join([product, str(year)]).lower().strip()
-        self.engine = None
-        self.session = None
-        self.geo = None
-        self.binding = None
-        self.db_name = "postgresql:///mydb"
-        self.df = self.create_df(
-            product, year, place_type, place, level, variables)
-        self.num_rows = self.df.shape[0]
+        self.query = (product, year, place_type, place, level, variables)
+
+    def describe(self):
+        '''
+        Retrieves the variables from the Census API and maps the resulting
+        columns to SQL types.
+        '''
+        if self.metadata is None:
+            self.df = self.create_df(*self.query)
+            if 'geometry' in self.df:
+                crs = self.df.crs
+                self.srid = crs.to_epsg() if crs else 4326
+                self.col_mappings[self.df['geometry'].dtype] = Geometry(
+                    geometry_type='GEOMETRY', srid=self.srid)
+            self.metadata = utils.spreadsheet_metadata(self)
+            self.num_rows = self.df.shape[0]
+        return self.metadata
+
+    def iter_batches(self):
+        '''
+        Yields the retrieved rows CENSUS_BATCH_ROWS at a time, so that their
+        geometries are encoded a batch at a time.
+        '''
+        self.describe()
+        for start in range(0, self.df.shape[0], CENSUS_BATCH_ROWS):
+            yield self.df.iloc[start:start + CENSUS_BATCH_ROWS]
 
     def create_df(self, product, year, place_type, place, level, variables):
-        if product == 'Decennial2010':
-            cen_prod = products.Decennial2010()
-        elif product == 'ACS' and year:
-            cen_prod = products.ACS(year)
-        elif product == 'ACS':
-            cen_prod = products.ACS()
-
-        place_mapper = {'msa': cen_prod.from_msa,
-                        'csa': cen_prod.from_csa,
-                        'county': cen_prod.from_county,
-                        'state': cen_prod.from_state,
-                        'placename': cen_prod.from_place}
         ui.item(("Retrieving variables %s for all %ss in %s. " +
             "This can take some time for large datasets.") % \
             (variables, level, place))
-        print()
-        print(place, level, variables)
-        df = place_mapper[place_type](
-            place, level=level, variables=variables)
+        df = census.get_frame(
+            product, year, place_type, place, level, variables)
         df.columns = [utils.clean_string(x) for x in df.columns]
         return df
 
-    def insert(self, circle_bar):
-        ui.item("Inserting into PostGIS.")
-        self.df.postgis.to_postgis(con=self.engine, table_name=self.tbl_name,
-            geometry='geometry', if_exists='replace')
-
 
 class Portal:
     '''
@@ -248,13 +384,30 @@ class Portal:
         self.geo = None
         self.binding = None
         self.db_name = "postgresql:///mydb"
+        # Rows already loaded by an interrupted run, set by resume()
+        self.resume_from = 0
+
+    def resume(self, rows):
+        '''
+        Continues an interrupted load after the first rows source rows.
+        '''
+        self.resume_from = rows
+
+    def checkpoint(self, session, rows):
+        '''
+        Saves the number of source rows loaded once rows more have been
+        written by this run. Called by the commit policy before it commits.
+        '''
+        state.set_state(
+            session, self.tbl_name, 'checkpoint', self.resume_from + rows)
 
 
 class SocrataPortal(Portal):
     '''
     Stores SODA data.
     '''
-    def __init__(self, site, dataset_id, app_token, tbl_name=None):
+    def __init__(self, site, dataset_id, app_token, tbl_name=None,
+                 page_size=5000, workers=4, keyset=False, incremental=False):
         Portal.__init__(self, site)
         self.col_mappings = {
             'checkbox': Boolean,
@@ -271,25 +424,88 @@ class SocrataPortal(Portal):
         self.dataset_id = dataset_id
         self.app_token = app_token
         self.client = Socrata(self.site, self.app_token)
-        self.tbl_name = utils.get_table_name(
-            self.client.get_metadata(self.dataset_id)['name']
-            ).lower() if not tbl_name else tbl_name
-        self.metadata = self.__get_metadata()
+        self.tbl_name = tbl_name
+        self.metadata = None
+        self.num_rows = None
         self.srid = 4326
+        self.page_size = page_size
+        self.workers = workers
+        self.keyset = keyset
+        self.incremental = incremental
+        self.syncing = False
+        self.high_water_mark = None
+        self._sync_where = None
+        # Keyset loads remember the :id of the last row committed
+        self.resume_after = None
+        self._page_ids = []
+        self._page_start = 0
+
+    def describe(self):
+        '''
+        Reads the dataset's name and columns with a single metadata request
+        and counts its rows. Both are served from the metadata cache when
+        the dataset has been described recently.
+        '''
+        if self.metadata is None:
+            key = 'socrata:%s/%s' % (self.site, self.dataset_id)
+            dataset = cache.get_metadata(key, self.__get_dataset)
+            self.tbl_name = self.tbl_name or \
+                utils.get_table_name(dataset['name']).lower()
+            self.metadata = self.__get_metadata(dataset['columns'])
+            if self.incremental:
+                # Rows are upserted on Socrata's :id
+                self.metadata.append(('socrata_id', Text))
+            # Only sizes the progress bar; the rows loaded are counted
+            self.num_rows = cache.get_metadata(
+                key + ':count', self.__count_rows)
+        return self.metadata
+
+    def resume(self, rows):
+        '''
+        Continues an interrupted load after the first rows source rows. A
+        keyset load continues after the last :id committed instead, so it
+        doesn't have to skip over rows with an offset.
+        '''
+        Portal.resume(self, rows)
+        if self.keyset and not self.incremental:
+            self.resume_after = state.get_state(
+                self.session, self.tbl_name, 'last_id')
+
+    def checkpoint(self, session, rows):
+        Portal.checkpoint(self, session, rows)
+        if self.keyset and self._page_ids:
+            state.set_state(session, self.tbl_name, 'last_id',
+                            self._page_ids[rows - self._page_start - 1])
+
+    def __get_dataset(self):
+        '''
+        The parts of the dataset's metadata that describe its table.
+        '''
+        dataset = self.client.get_metadata(self.dataset_id)
+        return {'name': dataset['name'],
+                'columns': [{'fieldName': col['fieldName'],
+                             'dataTypeName': col['dataTypeName']}
+                            for col in dataset['columns']]}
 
-        self.num_rows = int(
-            self.client.get(
-                self.dataset_id, select='COUNT(*) AS count'))[0]['count']
-        self.data = self.__get_socrata_data(5000)
-
-    def __get_metadata(self):
+    def iter_batches(self):
+        '''
+        Yields the dataset a page at a time as it is downloaded.
+        '''
+        self.describe()
+        if self.incremental:
+            return self.__get_sync_data(self._sync_where, self.page_size)
+        if self.keyset:
+            return self.__get_keyset_data(self.page_size)
+        return self.__get_socrata_data(self.page_size)
+
+    def __get_metadata(self, columns):
         '''
         Uses provided metadata to map column types to SQLAlchemy.
         '''
         ui.item("Gathering metadata")
         print()
         metadata = []
-        for col in self.client.get_metadata(self.dataset_id)['columns']:
+        for col in columns:
             print(col['fieldName'], ":", col['dataTypeName'])
             try:
                 metadata.append(
@@ -300,69 +516,159 @@ class SocrataPortal(Portal):
                 continue
         return metadata
 
+    def __count_rows(self, where=None):
+        params = {'select': 'COUNT(*) AS count'}
+        if where:
+            params['where'] = where
+        return int(self.client.get(self.dataset_id, **params)[0]['count'])
 
+    def __get_page(self, **params):
+        '''
+        Requests a single page from the Socrata API, retrying on failure.
+        '''
+        while True:
+            try:
+                return self.client.get(self.dataset_id, **params)
+            except:
+                ui.item("Sleeping for 10 seconds to avoid timeout")
+                time.sleep(10)
 
     def __get_socrata_data(self, page_size=5000):
         '''
-        Iterate over a datasets pages using the Socrata API
+        Iterate over a datasets pages using the Socrata API. Pages are
+        downloaded self.workers at a time and yielded in order. Rows are
+        ordered by :id so that a resumed load lines up with the first run.
         '''
         ui.item(
             "Gathering data (this can take a bit for large datasets).")
-        page_num = 0
-        more_pages = True
 
-        while more_pages:
-            try:
+        def get_page(page_num):
+            return self.__get_page(
+                order=':id', limit=page_size,
+                offset=self.resume_from + page_size * page_num)
 
-                api_data = self.client.get(
-                    self.dataset_id,
-                    limit=page_size,
-                    offset=page_size * page_num,
-                )
+        return fetch.prefetch(
+            get_page, itertools.count(), workers=self.workers,
+            is_last=lambda api_data: len(api_data) < page_size)
 
-                if len(api_data) < page_size:
-                    more_pages = False
-                page_num += 1
+    def __get_keyset_data(self, page_size=5000):
+        '''
+        Iterate over a datasets pages ordered by the :id system field, asking
+        for the rows after the last :id seen instead of using an offset. Every
+        page costs the same no matter how deep into the dataset it is and rows
+        can't be skipped or repeated between pages. Each page depends on the
+        one before it, so the next page is downloaded in the background while
+        the current one is written.
+        '''
+        ui.item(
+            "Gathering data (this can take a bit for large datasets).")
+
+        def get_pages():
+            params = {'select': ':id, *', 'order': ':id', 'limit': page_size}
+            if self.resume_after:
+                params['where'] = ":id > '%s'" % self.resume_after
+            elif self.resume_from:
+                # Checkpoints saved without the last :id
+                params['offset'] = self.resume_from
+            while True:
+                api_data = self.__get_page(**params)
                 yield api_data
+                if len(api_data) < page_size:
+                    return
+                params.pop('offset', None)
+                params['where'] = ":id > '%s'" % api_data[-1][':id']
 
-            except:
-                ui.item("Sleeping for 10 seconds to avoid timeout")
-                time.sleep(10)
+        return fetch.background(get_pages())
+
+    def start_sync(self, table_exists):
+        '''
+        Prepares an incremental sync once the database connection is open.
+        If the destination table was loaded by an earlier sync, only rows
+        whose :updated_at is past the saved high-water mark are fetched and
+        they are upserted on :id. Otherwise the whole dataset is loaded.
+        Returns whether the existing table should be kept.
+        '''
+        if table_exists:
+            self.high_water_mark = state.get_state(
+                self.session, self.tbl_name, 'updated_at')
+        self.syncing = bool(self.high_water_mark)
+        if self.syncing:
+            self._sync_where = ":updated_at > '%s'" % self.high_water_mark
+            self.num_rows = self.__count_rows(self._sync_where)
+            ui.item("Syncing %s rows updated since %s." % (
+                self.num_rows, self.high_water_mark))
+        return self.syncing
+
+    def __get_sync_data(self, where, page_size=5000):
+        '''
+        Iterate over the pages of rows matching where, ordered by
+        :updated_at and :id so that offset paging is stable. Each row's :id
+        is kept as socrata_id and the latest :updated_at is tracked as the
+        next high-water mark.
+        '''
+        ui.item(
+            "Gathering data (this can take a bit for large datasets).")
+        params = {'select': ':id, :updated_at, *',
+                  'order': ':updated_at, :id'}
+        if where:
+            params['where'] = where
+
+        def get_page(page_num):
+            return self.__get_page(
+                limit=page_size,
+                offset=self.resume_from + page_size * page_num, **params)
+
+        for page in fetch.prefetch(
+                get_page, itertools.count(), workers=self.workers,
+                is_last=lambda api_data: len(api_data) < page_size):
+            for row in page:
+                row['socrata_id'] = row.pop(':id')
+                updated_at = row.pop(':updated_at')
+                if not self.high_water_mark or \
+                        updated_at > self.high_water_mark:
+                    self.high_water_mark = updated_at
+            yield page
 
     def insert(self, circle_bar):
-        for page in self.data:
-            utils.insert_data(
-                page, self.session, circle_bar, self.binding, srid=self.srid, \
-                socrata=True)
-        pass
+        table = self.binding.__table__
+        rows_written = 0
+        for page in self.iter_batches():
+            if self.keyset and not self.incremental:
+                # Lets checkpoint() find the :id of the last row committed
+                self._page_ids = [row.get(':id') for row in page]
+                self._page_start = rows_written
+            if self.syncing and page:
+                # Replace rows that changed since the last sync
+                self.session.execute(table.delete().where(
+                    table.c.socrata_id.in_(
+                        [row['socrata_id'] for row in page])))
+            rows_written += utils.insert_data(
+                page, self.session, circle_bar, self.binding, srid=self.srid)
+        self.num_rows = self.resume_from + rows_written
+        if self.incremental:
+            if not self.syncing:
+                Index('ix_%s_socrata_id' % self.tbl_name,
+                      table.c.socrata_id).create(self.session.connection())
+            if self.high_water_mark:
+                state.set_state(self.session, self.tbl_name, 'updated_at',
+                                self.high_water_mark)
 
 
 class HudPortal(Portal):
     '''
     Stores HUD data
     '''
-    def __init__(self, site):
+    def __init__(self, site, workers=4):
         Portal.__init__(self, site)
         self.name = "HUD"
-        self.description = str(
-            urllib.request.urlopen(
-                re.search('.*FeatureServer/', self.site).group()
-                ).read()
-            )
-        self.tbl_name = utils.get_table_name(BeautifulSoup(
-            self.description, 'html.parser'
-            ).title.string.rstrip(' (FeatureServer)')).lower()     
-        self.data_info = json.loads(
-            urllib.request.urlopen(
-                self.site + "&outFields=*&outSR=4326&f=json").read())
-        self.srid = self.data_info['spatialReference']['wkid']
+        self.workers = workers
+        self.tbl_name = None
+        self.metadata = None
+        self.num_rows = None
+        self.description = None
         self._query = '' if "1%3D1" in \
             re.search("where=\S*", self.site).group() else \
             re.search("where=\S*", self.site).group()
-        self._dataset_code = re.search(
-            '(?<=Service ItemId:</b> )\w*', self.description).group()
-        self.data = self._get_data()
-        self.num_rows = len(self.data)
         self.col_mappings = {
             'esriFieldTypeString': Text,
             'esriFieldTypeInteger': Integer,
@@ -372,21 +678,159 @@ class HudPortal(Portal):
             'esriFieldTypeSingle': Numeric,
             'esriFieldTypeDate': DateTime,
             'esriFieldTypeGlobalID': Text}
-        self.metadata = self.__get_metadata()
 
-    def _get_data(self):
+    def describe(self):
+        '''
+        Reads the layer's fields, row count and paging limits through the
+        metadata cache. The service page is only read when it is needed for
+        the default table name.
+        '''
+        if self.metadata is None:
+            if not self.tbl_name:
+                self.tbl_name = utils.get_table_name(BeautifulSoup(
+                    self.__get_description(), 'html.parser'
+                    ).title.string.rstrip(' (FeatureServer)')).lower()
+            # A single row without geometry is enough for the fields
+            self.data_info = cache.get_json(
+                self.site + "&outFields=*&outSR=4326&returnGeometry=false"
+                "&resultRecordCount=1&f=json",
+                keys=('fields', 'spatialReference'))
+            # Features are always requested in 4326 (see _query_params)
+            self.srid = self.data_info.get(
+                'spatialReference', {}).get('wkid', 4326)
+            # Only sizes the progress bar; the rows loaded are counted
+            self.num_rows = cache.get_json(
+                self.site + "&returnCountOnly=true&f=json")['count']
+            self.metadata = self.__get_metadata()
+            self.__get_layer_info()
+        return self.metadata
+
+    def iter_batches(self):
+        '''
+        Yields the layer's rows a page at a time as they are downloaded.
+        '''
+        self.describe()
+        ui.item(
+            "Gathering data (this can take a bit for large datasets).")
+        if self.paged:
+            for page in self._get_paged_data():
+                yield list(utils.geojson_rows(page))
+            return
+        # Layers that can't be paged are downloaded as a single export
+        with self._open_geojson() as stream:
+            for batch in utils.batches(self._get_data(stream)):
+                yield batch
+
+    def __get_description(self):
+        if self.description is None:
+            url = re.search('.*FeatureServer/', self.site).group()
+            self.description = cache.get_metadata(
+                url, lambda: requests.get(url).text)
+        return self.description
+
+    def __get_layer_info(self):
         '''
-        Parses the GeoService URL to obtain the geojson download URL and uses
-        the geojson to obtain data.
+        Reads the page size and pagination support of the FeatureServer
+        layer behind the query URL.
         '''
-        def load_geojson(self):
-            return json.loads(urllib.request.urlopen(
-                'https://opendata.arcgis.com/datasets/%s_0.geojson%s' %
-                (self._dataset_code, '?' + self._query)).read())
+        layer_url = re.search(r'.*FeatureServer/\d+', self.site)
+        self._layer_url = layer_url.group() if layer_url else None
+        self.layer_info = cache.get_json(
+            self._layer_url + '?f=json',
+            keys=('maxRecordCount', 'objectIdField',
+                  'advancedQueryCapabilities')) if self._layer_url else {}
+        self.page_size = self.layer_info.get('maxRecordCount') or 1000
+        self.paged = self.layer_info.get(
+            'advancedQueryCapabilities', {}).get('supportsPagination', False)
+
+    def _query_params(self):
+        '''
+        The parameters of the query URL, including any where filter, with
+        the ones used for paging replaced.
+        '''
+        params = dict(urllib.parse.parse_qsl(
+            urllib.parse.urlsplit(self.site).query))
+        for key in ('f', 'resultOffset', 'resultRecordCount',
+                    'returnCountOnly', 'returnIdsOnly'):
+            params.pop(key, None)
+        params.setdefault('where', '1=1')
+        params.setdefault('outFields', '*')
+        params['outSR'] = 4326
+        params['f'] = 'geojson'
+        if self.layer_info.get('objectIdField'):
+            # Offsets are only stable when the order is fixed
+            params.setdefault(
+                'orderByFields', self.layer_info['objectIdField'])
+        return params
+
+    def _get_page(self, offset, params):
+        '''
+        Requests the page of features starting at offset. ArcGIS may return
+        fewer features than asked for while more remain, flagging it with
+        exceededTransferLimit, in which case the rest of the page is
+        requested until it is full or the layer runs out.
+        '''
+        features = []
+        while True:
+            page = self._request_page(dict(
+                params, resultOffset=offset + len(features),
+                resultRecordCount=self.page_size - len(features)))
+            features.extend(page['features'])
+            exceeded = page.get('exceededTransferLimit') or \
+                page.get('properties', {}).get('exceededTransferLimit')
+            if not exceeded or not page['features'] or \
+                    len(features) >= self.page_size:
+                return features
+
+    def _request_page(self, params):
+        '''
+        Requests a page of the query endpoint, retrying on failure.
+        '''
+        def request():
+            response = requests.get(
+                self._layer_url + '/query', params=params, timeout=300)
+            response.raise_for_status()
+            page = response.json()
+            # ArcGIS reports errors with a 200 status
+            if 'error' in page:
+                raise ValueError(page['error'])
+            return page
+        return fetch.retry(request)
+
+    def _get_paged_data(self):
+        '''
+        Pages through the layer's query endpoint, maxRecordCount features
+        at a time, with self.workers pages downloading at once. Pages of
+        features are yielded in order as they arrive.
+        '''
+        params = self._query_params()
+
+        def get_page(page_num):
+            return self._get_page(
+                self.resume_from + self.page_size * page_num, params)
 
-        geojson = load_geojson(self)
+        return fetch.prefetch(
+            get_page, itertools.count(), workers=self.workers,
+            is_last=lambda features: len(features) < self.page_size)
 
-        return utils.geojson_data(geojson)
+    def _get_data(self, stream):
+        '''
+        Streams rows from the geojson download as it is read, skipping the
+        features already loaded by an interrupted run.
+        '''
+        return utils.geojson_rows(itertools.islice(
+            streams.iter_features(stream), self.resume_from, None))
+
+    def _open_geojson(self):
+        '''
+        Uses the item ID parsed from the GeoService page to open the geojson
+        download URL.
+        '''
+        dataset_code = re.search(
+            '(?<=Service ItemId:</b> )\w*', self.__get_description()).group()
+        return cache.open_url(
+            'https://opendata.arcgis.com/datasets/%s_0.geojson%s' %
+            (dataset_code, '?' + self._query))
 
     def __get_metadata(self):
         '''
@@ -404,6 +848,8 @@ class HudPortal(Portal):
         return metadata
 
     def insert(self, circle_bar):
-        utils.insert_data(
-            self.data, self.session, circle_bar, self.binding, srid=self.srid)
-        return
+        rows_written = 0
+        for batch in self.iter_batches():
+            rows_written += utils.insert_data(
+                batch, self.session, circle_bar, self.binding, srid=self.srid)
+        self.num_rows = self.resume_from + rows_written
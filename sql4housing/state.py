@@ -0,0 +1,62 @@
+'''
+Small key/value store kept in the destination database to remember the
+progress of each loaded table between runs.
+'''
+from datetime import datetime
+from sqlalchemy import Column, MetaData, Table, and_, select
+from sqlalchemy.types import DateTime, Text
+
+STATE_TABLE = 'sql4housing_state'
+
+state_table = Table(
+    STATE_TABLE, MetaData(),
+    Column('tbl_name', Text, primary_key=True),
+    Column('key', Text, primary_key=True),
+    Column('value', Text),
+    Column('updated', DateTime))
+
+
+def get_state(session, tbl_name, key):
+    '''
+    Returns the value saved for a table under key, or None.
+    '''
+    if not _exists(session):
+        return None
+    return session.execute(
+        select([state_table.c.value]).where(and_(
+            state_table.c.tbl_name == tbl_name,
+            state_table.c.key == key))
+        ).scalar()
+
+
+def set_state(session, tbl_name, key, value):
+    '''
+    Saves value for a table under key. The change is committed along with
+    the rest of the session.
+    '''
+    state_table.create(session.connection(), checkfirst=True)
+    session.execute(state_table.delete().where(and_(
+        state_table.c.tbl_name == tbl_name,
+        state_table.c.key == key)))
+    session.execute(state_table.insert().values(
+        tbl_name=tbl_name, key=key, value=str(value),
+        updated=datetime.now()))
+
+
+def clear_state(session, tbl_name, key=None):
+    '''
+    Forgets everything saved for a table, e.g. after it has been replaced,
+    or only the value saved under key. The state table is only created
+    once something is saved, so this doesn't create it.
+    '''
+    if not _exists(session):
+        return
+    condition = state_table.c.tbl_name == tbl_name
+    if key:
+        condition = and_(condition, state_table.c.key == key)
+    session.execute(state_table.delete().where(condition))
+
+
+def _exists(session):
+    conn = session.connection()
+    return conn.dialect.has_table(conn, STATE_TABLE)
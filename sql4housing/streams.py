@@ -0,0 +1,125 @@
+'''
+Incremental readers for large remote or local files.
+'''
+import codecs
+from contextlib import closing
+import io
+import json
+import os
+import tempfile
+
+import requests
+
+from sql4housing import cache
+
+CHUNK_SIZE = 1 << 16
+WHITESPACE = ' \t\r\n'
+
+
+def open_location(location):
+    '''
+    Opens a local path, a URL or a raw JSON string as a binary stream.
+    '''
+    if os.path.exists(location):
+        return open(location, 'rb')
+    if location.lstrip().startswith(('{', '[')):
+        return io.BytesIO(location.encode('utf-8'))
+    return cache.open_url(location)
+
+
+def download(url, directory, chunk_size=CHUNK_SIZE):
+    '''
+    Streams url into a new file in directory a chunk at a time and returns
+    the file's path.
+    '''
+    fd, path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'wb') as f, closing(
+            requests.get(url, stream=True)) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size):
+            f.write(chunk)
+    return path
+
+
+class _Buffer:
+    '''
+    Decoded text read from a stream a chunk at a time. Only the text that
+    hasn't been consumed yet is kept.
+    '''
+    def __init__(self, stream, chunk_size=CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+        self.text = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        '''
+        Reads at least a chunk and at least as much as is already buffered,
+        so values spanning many chunks are decoded in linear time.
+        '''
+        remaining = self.text[self.pos:]
+        chunk = self.stream.read(max(self.chunk_size, len(remaining)))
+        if isinstance(chunk, bytes):
+            chunk = self.decoder.decode(chunk, final=not chunk)
+        if not chunk:
+            self.eof = True
+        self.text = remaining + chunk
+        self.pos = 0
+
+    def peek(self, skip=WHITESPACE):
+        '''
+        Skips characters in skip and returns the next one, or '' at the end.
+        '''
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in skip:
+                self.pos += 1
+            if self.pos < len(self.text) or self.eof:
+                return self.text[self.pos:self.pos + 1]
+            self.fill()
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('Expected "%s" in GeoJSON at "%s"' % (
+                char, self.text[self.pos:self.pos + 20]))
+        self.pos += 1
+
+    def decode(self):
+        '''
+        Decodes the JSON value at the current position.
+        '''
+        self.peek()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.text, self.pos)
+                if end < len(self.text) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def iter_features(stream, chunk_size=CHUNK_SIZE):
+    '''
+    Yields the features of a GeoJSON FeatureCollection one at a time while
+    the stream is read, so the whole document is never held in memory.
+    '''
+    buf = _Buffer(stream, chunk_size)
+    buf.expect('{')
+    while buf.peek(WHITESPACE + ',') not in ('}', ''):
+        key = buf.decode()
+        buf.expect(':')
+        if key != 'features':
+            buf.decode()
+            continue
+        buf.expect('[')
+        while buf.peek(WHITESPACE + ',') not in (']', ''):
+            yield buf.decode()
+        buf.expect(']')
+    # Read to the end of the stream so that a cached download is completed
+    while stream.read(chunk_size):
+        pass
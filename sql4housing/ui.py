@@ -3,7 +3,7 @@ def header(header_str, color=''):
 
 
 def item(item_str):
-	try:
+    try:
         print('  ▶ %s' % item_str)
     except UnicodeEncodeError:
         print('  - %s' % item_str)
@@ -2,17 +2,30 @@
 Utility functions
 '''
 import re
+from sqlalchemy import Index, inspect
 from sqlalchemy.orm import sessionmaker
 from progress.bar import FillingCirclesBar
-from sqlalchemy.types import DateTime, Text
+from sqlalchemy.types import \
+    BigInteger, Boolean, Date, DateTime, Integer, Numeric, Text
 from geoalchemy2.types import Geometry
 import urllib
+import numpy as np
+import pandas as pd
 import json
+import collections.abc
+import functools
+import itertools
+import math
+import random
 import string
 import warnings
+import weakref
 
-from sql4housing.parsers import parse_datetime, parse_geom, parse_str
+from sql4housing.parsers import DatetimeParser, \
+    parse_datetime, parse_geom, parse_geoms, parse_str, encode_geoms
+from sql4housing import state
 from sql4housing import ui
+from sql4housing.bulk import BulkWriter, COPY_BATCH_SIZE
 
 def get_table_name(raw_str):
     '''
@@ -24,22 +37,58 @@ def get_table_name(raw_str):
     no_spaces = raw_str.replace(' ', '_')
     return re.sub(r'\W', '', no_spaces).lower()
 
-def insert_data(page, session, circle_bar, Binding, srid=4326, socrata=False):
+def insert_data(page, session, circle_bar, Binding, srid=4326):
     '''
-    Inserts data into binding after parsing values in each row. Shows progress
-    on circle bar.
+    Parses the values in each row and writes them into the binding's table
+    with the bulk writer. Shows progress on circle bar.
     '''
-    to_insert = []
-
+    writer = BulkWriter(
+        session, Binding.__table__, circle_bar,
+        batch_parsers=get_batch_parsers(Binding, srid))
+    converter = get_converter(Binding)
     for row in page:
-        to_insert.append(Binding(**parse_row(row, Binding, srid)))
-        if not socrata:
-            circle_bar.next()
-    session.add_all(to_insert)
-    if socrata:
-        circle_bar.next(n=len(to_insert))
+        writer.write(convert_row(row, converter, srid))
+    writer.flush()
+
+    return writer.rows_written
+
+def insert_frame(df, session, circle_bar, Binding, srid=4326):
+    '''
+    Converts a DataFrame a column at a time and writes it into the binding's
+    table with the bulk writer. Shows progress on circle bar.
+    '''
+    writer = BulkWriter(session, Binding.__table__, circle_bar)
+    writer.write_frame(convert_frame(df, Binding, writer.col_names, srid))
 
-    return
+    return writer.rows_written
+
+def convert_frame(df, binding, col_names, srid=4326):
+    '''
+    Vectorized counterpart of parse_row for DataFrame-backed sources. Returns
+    a DataFrame holding col_names in order, with NaN and "nan" strings as
+    NULL, timestamps as datetimes, text columns as strings and shapely
+    geometries as hex EWKB.
+    '''
+    binding_columns = binding.__mapper__.columns
+    columns = {clean_string(col_name): col_name for col_name in df.columns}
+    converted = pd.DataFrame(index=df.index)
+    for col_name in col_names:
+        if col_name not in columns:
+            converted[col_name] = None
+            continue
+        col = df[columns[col_name]]
+        col_type = type(binding_columns[col_name].type)
+        if col_type is DateTime:
+            col = pd.to_datetime(col, errors='coerce')
+        elif col_type is Geometry:
+            col = pd.Series(encode_geoms(col, srid), index=df.index,
+                            dtype=object)
+        elif col_type is Text and pd.api.types.is_string_dtype(col):
+            col = col.where(col.notna() & (col != 'nan'), None)
+            col = col.map(lambda val: parse_str(val) if isinstance(
+                val, dict) else val)
+        converted[col_name] = col
+    return converted
 
 def clean_string(sub_str):
     return re.compile('[%s]' % re.escape(string.punctuation)).sub(
@@ -51,15 +100,42 @@ def geojson_data(geojson):
     '''
     ui.item(
         "Gathering data (this can take a bit for large datasets).")
-    new_data = []
-    data = geojson['features']
-    for row in data:
+    return list(geojson_rows(geojson['features']))
+
+def batches(rows, size=COPY_BATCH_SIZE):
+    '''
+    Groups an iterable of rows into lists of at most size rows.
+    '''
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+def geojson_rows(features):
+    '''
+    Lazily reformats the variable names of each feature in an iterable of
+    geojson features.
+    '''
+    for row in features:
         output = \
             {k.lower().replace(" ", "_"): v \
             for k, v in row['properties'].items()}
         output['geometry'] = row['geometry']
-        new_data.append(output)
-    return new_data
+        yield output
+
+def shapefile_rows(reader):
+    '''
+    Lazily yields each shape record of a shapefile reader in the same form
+    as geojson_data, so only one feature is held in memory at a time.
+    '''
+    field_names = [field[0].lower().replace(" ", "_") \
+        for field in reader.fields[1:]]
+    for shape_record in reader.iterShapeRecords():
+        output = dict(zip(field_names, shape_record.record))
+        output['geometry'] = shape_record.shape.__geo_interface__
+        yield output
 
 def edit_columns(df):
     '''
@@ -69,17 +145,16 @@ def edit_columns(df):
         [col_name.lower().replace(" ", "_") for col_name in df.columns]
     return df
 
+# This maps SQLAlchemy types (key) to functions that return their
+# expected Python type from the raw source data.
+PARSERS = {
+    DateTime: parse_datetime,
+    Geometry: parse_geom,
+    Text: parse_str,
+}
+
 def parse_row(row, binding, srid):
     """Parse API data into the Python types our binding expects"""
-    parsers = {
-        # TO DO: move to classes
-        # This maps SQLAlchemy types (key) to functions that return their
-        # expected Python type from the raw Socrata data.
-        DateTime: parse_datetime,
-        Geometry: parse_geom,
-        Text: parse_str,
-    }
-
     parsed = {}
     binding_columns = binding.__mapper__.columns
     for col_name, col_val in row.items():
@@ -90,38 +165,171 @@ def parse_row(row, binding, srid):
             continue
 
         mapper_col_type = type(binding_columns[col_name].type)
-        if mapper_col_type in parsers:
-            parsed[col_name] = parsers[mapper_col_type](col_val, srid)
+        if mapper_col_type in PARSERS:
+            parsed[col_name] = PARSERS[mapper_col_type](col_val, srid)
         else:
             parsed[col_name] = col_val
 
     return parsed
 
-def create_metadata(data, mappings):
+# Types whose values are converted a batch at a time by the bulk writer
+# instead of one by one in the row converter. Each value makes the parser
+# for one column, which is kept for every batch written to that column.
+BATCH_PARSERS = {
+    DateTime: DatetimeParser,
+    Geometry: lambda: parse_geoms,
+}
+
+_converters = weakref.WeakKeyDictionary()
+_batch_parsers = weakref.WeakKeyDictionary()
+
+def get_converter(binding):
+    '''
+    Returns the row converter for a binding, compiling it on first use: an
+    ordered list of (source_key, target_column, parser) tuples, one per
+    column of the binding's table. parser is None for values that are
+    written as they are or left to BATCH_PARSERS.
+    '''
+    if binding not in _converters:
+        _converters[binding] = [
+            (col.name, col.name, None if type(col.type) in BATCH_PARSERS
+             else PARSERS.get(type(col.type)))
+            for col in binding.__table__.columns if not col.primary_key]
+    return _converters[binding]
+
+def get_batch_parsers(binding, srid):
+    '''
+    Returns the batch parsers for the binding's columns, keyed by column
+    name. They are made on first use and cached, so e.g. the format detected
+    for a datetime column carries over from one page to the next.
+    '''
+    if binding not in _batch_parsers:
+        _batch_parsers[binding] = {
+            col.name: BATCH_PARSERS[type(col.type)]()
+            for col in binding.__table__.columns
+            if type(col.type) in BATCH_PARSERS}
+    return {name: functools.partial(parser, srid=srid)
+            for name, parser in _batch_parsers[binding].items()}
+
+def convert_row(row, converter, srid):
+    '''
+    Applies a compiled converter to a row. Same result as parse_row for rows
+    with lowercase keys, without looking anything up per value.
+    '''
+    get = row.get
+    return {target: parser(get(key), srid) if parser else get(key)
+            for key, target, parser in converter}
+
+# Bounds on the work done to infer a schema: the number of rows whose values
+# are inspected, and the number of rows an iterator is scanned for them.
+SAMPLE_ROWS = 1000
+SCAN_ROWS = 100000
+
+def create_metadata(data, mappings, sample_rows=SAMPLE_ROWS,
+                    scan_rows=SCAN_ROWS):
     '''
     Given a dictionary of data, maps python types of each value to
-    SQLAlchemy types.
+    SQLAlchemy types. Types are inferred from a random sample of at most
+    sample_rows rows, promoting columns with mixed values along
+    WIDENING_ORDER, so the cost doesn't grow with the size of the data.
+    '''
+    ui.item("Gathering metadata")
+    print()
+    sample = sample_data(data, sample_rows, scan_rows)
+    col_names = []
+    for record in sample:
+        col_names.extend(k for k in record if k not in col_names)
+
+    metadata = []
+    for col_name in col_names:
+        if col_name == 'geometry':
+            metadata.append(
+                (col_name, Geometry(geometry_type='GEOMETRY', srid=4326)))
+            continue
+        values = [record.get(col_name) for record in sample]
+        present = [val for val in values if not is_null(val)]
+        try:
+            col_type = infer_type(present, mappings)
+        except KeyError:
+            warnings.warn(
+                'Unable to map "%s" to a SQL type.' % col_name)
+            continue
+        print(col_name, ":", col_type.__name__,
+              "(nullable)" if len(present) < len(values) else "")
+        metadata.append((col_name, col_type))
+    return metadata
+
+def sample_data(data, sample_rows=SAMPLE_ROWS, scan_rows=SCAN_ROWS):
+    '''
+    Returns a uniform random sample of at most sample_rows rows. Lists are
+    sampled by index; other iterables are reservoir sampled over their first
+    scan_rows rows. The sample is seeded so reruns infer the same schema.
+    '''
+    rng = random.Random(0)
+    if isinstance(data, collections.abc.Sequence):
+        if len(data) <= sample_rows:
+            return list(data)
+        return [data[i] for i in sorted(
+            rng.sample(range(len(data)), sample_rows))]
+    sample = []
+    for i, record in enumerate(itertools.islice(data, scan_rows)):
+        if i < sample_rows:
+            sample.append(record)
+        else:
+            j = rng.randint(0, i)
+            if j < sample_rows:
+                sample[j] = record
+    return sample
+
+def is_null(val):
+    return val is None or val == '' or \
+        (isinstance(val, float) and math.isnan(val))
+
+def infer_type(values, mappings):
+    '''
+    Returns the narrowest SQLAlchemy type that holds every value, or Text if
+    there are no values. Integers are sized as Integer, BigInteger or
+    Numeric. Raises KeyError for values that mappings can't map.
+    '''
+    col_type = None
+    for val in values:
+        val_type = mappings[type(val)]
+        if val_type is Integer:
+            if not -2 ** 31 <= val < 2 ** 31:
+                val_type = BigInteger if -2 ** 63 <= val < 2 ** 63 \
+                    else Numeric
+        col_type = val_type if col_type is None \
+            else widen_type(col_type, val_type)
+        if col_type is Text:
+            break
+    return col_type or Text
+
+def shapefile_metadata(reader):
+    '''
+    Maps the DBF field descriptors of a shapefile reader into SQLAlchemy
+    types without reading any records.
     '''
     ui.item("Gathering metadata")
     print()
     metadata = []
-    for col_name in data[0].keys():
-
-        for record in data:
-            if col_name == 'geometry':
-                metadata.append(
-                    (col_name, Geometry(geometry_type='GEOMETRY', srid=4326)))
-                break
-            elif record[col_name]:
-                try:        
-                    py_type = type(record[col_name])
-                    print(col_name, ":", py_type)
-                    metadata.append((col_name, mappings[py_type]))
-                    break
-                except KeyError:
-                    warnings.warn(
-                        'Unable to map "%s" to a SQL type.' % col_name)
-                    break
+    # The first field is the DBF deletion flag
+    for name, field_type, size, decimal in reader.fields[1:]:
+        col_name = name.lower().replace(" ", "_")
+        print(col_name, ":", field_type)
+        if field_type == 'N' and not decimal:
+            metadata.append((col_name, BigInteger if size > 9 else Integer))
+        elif field_type in ('N', 'F'):
+            metadata.append((col_name, Numeric))
+        elif field_type == 'L':
+            metadata.append((col_name, Boolean))
+        elif field_type == 'D':
+            metadata.append((col_name, Date))
+        elif field_type in ('C', 'M'):
+            metadata.append((col_name, Text))
+        else:
+            warnings.warn('Unable to map "%s" to a SQL type.' % col_name)
+    metadata.append(
+        ('geometry', Geometry(geometry_type='GEOMETRY', srid=4326)))
     return metadata
 
 def spreadsheet_metadata(spreadsheet):
@@ -134,9 +342,159 @@ def spreadsheet_metadata(spreadsheet):
     metadata = []
     for col_name, col_type in dict(spreadsheet.df.dtypes).items():
         print(col_name, ":", col_type)
-        try:
-            metadata.append((col_name, spreadsheet.col_mappings[col_type]))
-        except KeyError:
+        sql_type = map_dtype(spreadsheet.col_mappings, col_type)
+        if sql_type is None:
             warnings.warn('Unable to map "%s" to a SQL type.' % col_name)
             continue
+        metadata.append((col_name, sql_type))
     return metadata
+
+def map_dtype(mappings, col_type):
+    '''
+    Returns the SQLAlchemy type mappings gives a pandas dtype, or None if it
+    has none.
+    '''
+    if col_type not in mappings:
+        if pd.api.types.is_string_dtype(col_type):
+            # pandas' own string dtype
+            col_type = np.dtype(object)
+        elif pd.api.types.is_datetime64_any_dtype(col_type):
+            # Timestamps of any unit or time zone
+            col_type = np.dtype('<M8[ns]')
+    return mappings.get(col_type)
+
+WIDENING_ORDER = [Integer, BigInteger, Numeric, Text]
+
+def widen_type(current, new):
+    '''
+    Returns the narrowest SQLAlchemy type able to hold values of both types.
+    Anything that can't be promoted along WIDENING_ORDER falls back to Text.
+    '''
+    if current is new:
+        return current
+    if current in WIDENING_ORDER and new in WIDENING_ORDER:
+        return max(current, new, key=WIDENING_ORDER.index)
+    return Text
+
+def widen_columns(spreadsheet, chunk):
+    '''
+    Compares the dtypes of a newly read chunk against the spreadsheet's table
+    and widens any column whose values no longer fit its SQL type.
+    '''
+    table = spreadsheet.binding.__table__
+    for col_name, col_type in dict(chunk.dtypes).items():
+        col_name = clean_string(col_name)
+        new_type = map_dtype(spreadsheet.col_mappings, col_type)
+        if col_name not in table.columns or not new_type:
+            continue
+        column = table.columns[col_name]
+        if isinstance(column.type, Geometry):
+            continue
+        if not isinstance(new_type, type):
+            # Types mapped as instances, such as CenPy's Geometry
+            new_type = type(new_type)
+        current = type(column.type)
+        widened = widen_type(current, new_type)
+        if widened is current:
+            continue
+        ui.item('Widening column "%s" from %s to %s.' % (
+            col_name, current.__name__, widened.__name__))
+        column.type = widened()
+        dialect = spreadsheet.session.get_bind().dialect
+        if dialect.name != 'postgresql':
+            # Other dialects such as SQLite don't enforce column types
+            continue
+        preparer = dialect.identifier_preparer
+        type_sql = column.type.compile(dialect=dialect)
+        spreadsheet.session.execute(
+            'ALTER TABLE %s ALTER COLUMN %s TYPE %s USING %s::%s' % (
+                preparer.format_table(table), preparer.quote(col_name),
+                type_sql, preparer.quote(col_name), type_sql))
+
+SHADOW_SUFFIX = '__loading'
+
+def swap_table(session, shadow_name, tbl_name):
+    '''
+    Replaces tbl_name with the freshly loaded shadow_name within the
+    session's transaction, so readers see either the old table or the new
+    one and never a missing or half-loaded table. The indexes of the shadow
+    table are renamed to match, as are the primary key and _pk_ sequence on
+    PostgreSQL, so the next load can create them again. Anything saved in
+    the state table for the replaced table, such as the high-water mark of
+    an incremental load, is forgotten along with it.
+    '''
+    conn = session.connection()
+    dialect = conn.dialect
+    preparer = dialect.identifier_preparer
+    inspector = inspect(conn)
+    indexes = inspector.get_indexes(shadow_name)
+    renames = []
+    if dialect.name == 'postgresql':
+        renames = [('INDEX', index['name']) for index in indexes]
+        pk_name = inspector.get_pk_constraint(shadow_name).get('name')
+        if pk_name:
+            renames.append(('INDEX', pk_name))
+        sequence = conn.execute(
+            "SELECT pg_get_serial_sequence(%(tbl)s, '_pk_')",
+            {'tbl': preparer.quote(shadow_name)}).scalar()
+        if sequence:
+            renames.append(('SEQUENCE', sequence.split('.')[-1].strip('"')))
+
+    if dialect.has_table(conn, tbl_name):
+        conn.execute('DROP TABLE %s' % preparer.quote(tbl_name))
+    state.clear_state(session, tbl_name)
+    conn.execute('ALTER TABLE %s RENAME TO %s' % (
+        preparer.quote(shadow_name), preparer.quote(tbl_name)))
+    for kind, name in renames:
+        if shadow_name in name:
+            conn.execute('ALTER %s %s RENAME TO %s' % (
+                kind, preparer.quote(name),
+                preparer.quote(name.replace(shadow_name, tbl_name))))
+    if dialect.name != 'postgresql':
+        # Other dialects such as SQLite can't rename indexes, so they are
+        # created again under the new name
+        for index in indexes:
+            if shadow_name not in index['name']:
+                continue
+            conn.execute('DROP INDEX %s' % preparer.quote(index['name']))
+            conn.execute('CREATE %sINDEX %s ON %s (%s)' % (
+                'UNIQUE ' if index['unique'] else '',
+                preparer.quote(index['name'].replace(shadow_name, tbl_name)),
+                preparer.quote(tbl_name),
+                ', '.join(preparer.quote(col)
+                          for col in index['column_names'])))
+
+def build_indexes(session, table, columns=(), analyze=False):
+    '''
+    Builds the indexes of a freshly loaded table in one pass, which is much
+    faster than keeping them up to date row by row while loading: a GiST
+    index on each geometry column when PostGIS is available and a B-tree
+    index on each of columns. Indexes that already exist are left alone.
+    Optionally runs ANALYZE afterwards so the planner knows the new data.
+    '''
+    conn = session.connection()
+    dialect = conn.dialect
+    existing = {index['name'] for index in inspect(conn).get_indexes(
+        table.name)}
+    indexes = []
+    if dialect.name == 'postgresql':
+        indexes += [
+            Index('idx_%s_%s' % (table.name, column.name), column,
+                  postgresql_using='gist')
+            for column in table.columns if isinstance(column.type, Geometry)]
+    for col_name in columns:
+        col_name = clean_string(col_name)
+        if col_name not in table.columns:
+            ui.item('Unable to index "%s"; no such column.' % col_name)
+            continue
+        indexes.append(Index('ix_%s_%s' % (table.name, col_name),
+                             table.columns[col_name]))
+    for index in indexes:
+        if index.name in existing:
+            continue
+        ui.item('Building index "%s".' % index.name)
+        index.create(conn)
+    if analyze:
+        ui.item('Analyzing "%s".' % table.name)
+        conn.execute('ANALYZE %s' % dialect.identifier_preparer.format_table(
+            table))